@@ -1,22 +1,117 @@
-from typing import Any, Union
+from typing import TYPE_CHECKING, Any, Optional, Union
+from method_accessor import MethodType, PrivateMethod, PublicMethod
+from undo_log import current_log
+
+if TYPE_CHECKING:
+    from oos import ObjectOrientedSystem as System
 
 
 class PublicAttr:
+    __slots__ = ("name", "value")
+
     def __init__(self, name: str, value: Any = None):
         self.name = name
         self.value = value
 
 
 class PrivateAttr:
+    __slots__ = ("name", "value")
+
     def __init__(self, name: str, value: Any = None):
         self.name = name
         self.value = value
 
 
 class ReadonlyAttr:
+    __slots__ = ("name", "value")
+
     def __init__(self, name: str, value: Any = None):
         self.name = name
         self.value = value
 
 
 AttrType = Union[PublicAttr, PrivateAttr, ReadonlyAttr]
+
+
+class AttrGetter:
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, index: int) -> None:
+        self.name = name
+        self.index = index
+
+    def __call__(self, sys: "System") -> Any:
+        return self.get(sys.environment.get_instance("this"))
+
+    def get(self, this: Any) -> Any:
+        return this.slots[self.index]
+
+
+def unshare(value: Any) -> Any:
+    # キャッシュで共有される数値の箱(タプルのスロット)は属性に入れる時に複製し、
+    # 属性が持つ箱は set-value でその場で書き換えられるようにする
+    slots = getattr(value, "slots", None)
+    if type(slots) is tuple:
+        return type(value)(value.class_type, list(slots))
+    return value
+
+
+class AttrSetter:
+    __slots__ = ("name", "index")
+
+    def __init__(self, name: str, index: int) -> None:
+        self.name = name
+        self.index = index
+
+    def __call__(self, sys: "System") -> None:
+        self.set(sys.environment.get_instance("this"), sys.send("args", "get-value"))
+
+    def set(self, this: Any, value: Any) -> None:
+        log = current_log.get()
+        if log is not None:
+            log.record(this.slots, self.index)
+        this.slots[self.index] = unshare(value)
+
+
+class IndexedAttrSetter(AttrSetter):
+    # 索引のある属性の書き込みは、書いた後に索引も更新する
+    # 取り消しでは値を戻した後に索引を更新し直す
+    __slots__ = ("indexes",)
+
+    def __init__(self, name: str, index: int, indexes: list[Any]) -> None:
+        super().__init__(name, index)
+        self.indexes = indexes
+
+    def set(self, this: Any, value: Any) -> None:
+        log = current_log.get()
+        if log is not None:
+            log.call(self.refresh, this)
+        super().set(this, value)
+        self.refresh(this)
+
+    def refresh(self, this: Any) -> None:
+        for index in self.indexes:
+            index.refresh(this)
+
+
+ACCESSOR_METHOD_TYPES: dict[
+    type[AttrType], tuple[type[MethodType], type[MethodType]]
+] = {
+    PublicAttr: (PublicMethod, PublicMethod),
+    PrivateAttr: (PrivateMethod, PrivateMethod),
+    ReadonlyAttr: (PublicMethod, PrivateMethod),
+}
+
+
+def build_getter_setter(
+    attr: AttrType, index: int, indexes: Optional[list[Any]] = None
+) -> tuple[MethodType, MethodType]:
+    GetterMethodClass, SetterMethodClass = ACCESSOR_METHOD_TYPES[type(attr)]
+    if indexes:
+        setter: AttrSetter = IndexedAttrSetter(attr.name, index, indexes)
+    else:
+        setter = AttrSetter(attr.name, index)
+    return (
+        GetterMethodClass(AttrGetter(attr.name, index)),
+        SetterMethodClass(setter),
+    )
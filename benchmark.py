@@ -0,0 +1,316 @@
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+from attr_accessor import PublicAttr
+from method_accessor import PrivateMethod, PublicMethod
+from oos import ObjectOrientedSystem
+
+Operation = Callable[[], Any]
+Scenario = Callable[[ObjectOrientedSystem], Operation]
+
+BASELINE_PATH = "benchmark_baseline.json"
+
+
+def deposit_by(currency: str) -> Callable[[ObjectOrientedSystem], Any]:
+    return lambda sys: sys.send(
+        "this",
+        f"set-{currency}",
+        value=sys.send(
+            sys.send("this", f"get-{currency}"),
+            "add",
+            value=sys.send("args", "get-value"),
+        ),
+    )
+
+
+def define_bank(system: ObjectOrientedSystem, **kwargs: Any) -> None:
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=lambda sys: sys.send(
+            "this", "set-dollars", value=sys.send("args", "get-dollars")
+        ),
+        **kwargs,
+    )
+
+
+def primitive_arithmetic(system: ObjectOrientedSystem) -> Operation:
+    system.send("env", "new", cls="int", name="x", value=10)
+    return lambda: system.send("x", "add", value=5)
+
+
+def getter_setter(system: ObjectOrientedSystem) -> Operation:
+    define_bank(system)
+    system.send("env", "new", cls="bank", name="my-account", dollars=100)
+    return lambda: (
+        system.send("my-account", "set-dollars", value=200),
+        system.send("my-account", "get-dollars"),
+    )
+
+
+def deep_inheritance(system: ObjectOrientedSystem) -> Operation:
+    define_bank(system, methods={"deposit": PublicMethod(deposit_by("dollars"))})
+    base = "bank"
+    for depth in range(20):
+        name = f"bank{depth}"
+        system.send("env", "define", name=name, bases=[base], attrs=[])
+        base = name
+    system.send("env", "new", cls=base, name="my-account")
+    system.send("my-account", "set-dollars", value=0)
+    return lambda: system.send("my-account", "deposit", value=1)
+
+
+def multiple_inheritance(system: ObjectOrientedSystem) -> Operation:
+    define_bank(
+        system, methods={"deposit_by_dollar": PublicMethod(deposit_by("dollars"))}
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        attrs=[PublicAttr("yen")],
+        methods={"deposit_by_yen": PublicMethod(deposit_by("yen"))},
+    )
+    system.send("env", "define", name="multi_bank", bases=["bank", "japan_bank"])
+    system.send("env", "new", cls="multi_bank", name="my-account")
+    system.send("my-account", "set-dollars", value=0)
+    system.send("my-account", "set-yen", value=0)
+    return lambda: (
+        system.send("my-account", "deposit_by_dollar", value=1),
+        system.send("my-account", "deposit_by_yen", value=1),
+    )
+
+
+def private_method(system: ObjectOrientedSystem) -> Operation:
+    define_bank(
+        system,
+        methods={
+            "deposit_by_dollar": PrivateMethod(deposit_by("dollars")),
+            "deposit": PublicMethod(
+                lambda sys: sys.send(
+                    "this", "deposit_by_dollar", value=sys.send("args", "get-value")
+                )
+            ),
+        },
+    )
+    system.send("env", "new", cls="bank", name="my-account", dollars=0)
+    return lambda: system.send("my-account", "deposit", value=1)
+
+
+def bank(system: ObjectOrientedSystem) -> Operation:
+    define_bank(
+        system,
+        methods={
+            "deposit": PublicMethod(deposit_by("dollars")),
+            "withdraw": PublicMethod(
+                lambda sys: sys.send(
+                    "this",
+                    "set-dollars",
+                    value=sys.send(
+                        sys.send(
+                            sys.send("this", "get-dollars"),
+                            "sub",
+                            value=sys.send("args", "get-value"),
+                        ),
+                        "max",
+                        value=0,
+                    ),
+                )
+            ),
+        },
+    )
+    system.send("env", "new", cls="bank", name="my-account", dollars=100)
+    return lambda: (
+        system.send("my-account", "deposit", value=50),
+        system.send("my-account", "withdraw", value=30),
+    )
+
+
+def polymorphism(system: ObjectOrientedSystem) -> Operation:
+    define_bank(
+        system,
+        methods={
+            "deposit_by_dollar": PublicMethod(deposit_by("dollars")),
+            "send": PublicMethod(
+                lambda sys: sys.send(
+                    sys.send("args", "get-to"),
+                    "deposit_by_dollar",
+                    value=sys.send("args", "get-amount"),
+                )
+            ),
+        },
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        attrs=[PublicAttr("yen")],
+        constructor=lambda sys: sys.send(
+            "this", "set-yen", value=sys.send("args", "get-yen")
+        ),
+        methods={
+            "deposit_by_dollar": PublicMethod(
+                lambda sys: sys.send(
+                    "this",
+                    "set-yen",
+                    value=sys.send(
+                        sys.send("this", "get-yen"),
+                        "add",
+                        value=sys.send(
+                            sys.send("args", "get-value"), "multiply", value=150
+                        ),
+                    ),
+                )
+            ),
+        },
+    )
+    system.send("env", "new", cls="bank", name="source_bank", dollars=100)
+    system.send("env", "new", cls="bank", name="dollar_bank", dollars=200)
+    system.send("env", "new", cls="japan_bank", name="yen_bank", yen=500)
+    return lambda: (
+        system.send("source_bank", "send", to="dollar_bank", amount=1),
+        system.send("source_bank", "send", to="yen_bank", amount=1),
+    )
+
+
+def instantiation(system: ObjectOrientedSystem) -> Operation:
+    define_bank(system)
+    return lambda: system.send("env", "new", cls="bank", name="account", dollars=1)
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "primitive_arithmetic": primitive_arithmetic,
+    "getter_setter": getter_setter,
+    "deep_inheritance": deep_inheritance,
+    "multiple_inheritance": multiple_inheritance,
+    "private_method": private_method,
+    "bank": bank,
+    "polymorphism": polymorphism,
+    "instantiation": instantiation,
+}
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def run_scenario(
+    scenario: Scenario, iterations: int, repeat: int = 5
+) -> dict[str, float]:
+    # 計測のオーバーヘッドを避けるため、時間とメモリは別々に測る
+    # スループットはノイズを避けるため、繰り返しのうち最良の値を使う
+    operation = scenario(ObjectOrientedSystem())
+    for _ in range(min(iterations, 100)):
+        operation()
+    samples = []
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            t = time.perf_counter()
+            operation()
+            samples.append(time.perf_counter() - t)
+        best = min(best, time.perf_counter() - start)
+    samples.sort()
+
+    tracemalloc.start()
+    operation = scenario(ObjectOrientedSystem())
+    for _ in range(iterations):
+        operation()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "ops_per_sec": iterations / best,
+        "mean_us": statistics.fmean(samples) * 1e6,
+        "p50_us": percentile(samples, 0.5) * 1e6,
+        "p90_us": percentile(samples, 0.9) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def run(
+    names: list[str], iterations: int, repeat: int = 5
+) -> dict[str, dict[str, float]]:
+    return {name: run_scenario(SCENARIOS[name], iterations, repeat) for name in names}
+
+
+def compare(
+    results: dict[str, dict[str, float]],
+    baseline: dict[str, dict[str, float]],
+    threshold: float,
+) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput {result['ops_per_sec']:.0f} ops/s "
+                f"< baseline {base['ops_per_sec']:.0f} ops/s"
+            )
+        if result["peak_memory_kb"] > base["peak_memory_kb"] * (1 + threshold):
+            regressions.append(
+                f"{name}: peak memory {result['peak_memory_kb']:.1f} KiB "
+                f"> baseline {base['peak_memory_kb']:.1f} KiB"
+            )
+    return regressions
+
+
+def format_results(results: dict[str, dict[str, float]]) -> str:
+    lines = [
+        f"{'scenario':<22} {'ops/s':>10} {'p50(us)':>9} {'p90(us)':>9} "
+        f"{'p99(us)':>9} {'peak(KiB)':>10}"
+    ]
+    for name, result in results.items():
+        lines.append(
+            f"{name:<22} {result['ops_per_sec']:>10.0f} {result['p50_us']:>9.1f} "
+            f"{result['p90_us']:>9.1f} {result['p99_us']:>9.1f} "
+            f"{result['peak_memory_kb']:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="benchmark the message-passing core")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario")
+    parser.add_argument("-n", "--iterations", type=int, default=2000)
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+
+    results = run(args.scenarios or list(SCENARIOS), args.iterations, args.repeat)
+    print(format_results(results))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
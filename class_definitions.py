@@ -1,13 +1,41 @@
-from method_accessor import MethodType
-from attr_accessor import AttrType
+import threading
+import weakref
+from method_accessor import MethodType, PrivateMethod
+from attr_accessor import AttrType, build_getter_setter
 from exceptions import MethodNotFound
-from typing import Iterable, Any, Callable, Protocol, Sequence
+from typing import (
+    Iterable,
+    Any,
+    Callable,
+    MutableSequence,
+    Optional,
+    Protocol,
+    Sequence,
+)
 
 MessageType = Any
 ClassConstructor = Callable[..., None]
 
 
+def no_constructor(sys: Any) -> None:
+    return None
+
+
+# テーブルの構築と無効化が並行して走らないようにする
+tables_lock = threading.RLock()
+
+
+class InstanceStorage(Protocol):
+    def new_slots(self) -> MutableSequence[Any]: ...
+
+    def compact(self) -> int: ...
+
+    def relayout(self, slots: Sequence[Any], layout: dict[str, int]) -> None: ...
+
+
 class ClassInterface(Protocol):
+    name: str
+
     @property
     def attrs(self) -> list[AttrType]: ...
 
@@ -20,6 +48,27 @@ class ClassInterface(Protocol):
     @bases.setter
     def bases(self, bases: Sequence["ClassInterface"]) -> None: ...
 
+    @property
+    def method_table(self) -> dict[str, MethodType]: ...
+
+    @property
+    def public_table(self) -> dict[str, MethodType]: ...
+
+    @property
+    def index_table(self) -> dict[str, list[Any]]: ...
+
+    @property
+    def attr_table(self) -> dict[str, AttrType]: ...
+
+    @property
+    def resolved_methods(self) -> dict[str, MethodType]: ...
+
+    @property
+    def layout(self) -> dict[str, int]: ...
+
+    @property
+    def default_slots(self) -> list[Any]: ...
+
     def get_default_attr(self) -> dict[str, AttrType]: ...
     def find_method(self, name: str) -> Iterable[MethodType]: ...
     def get_method(self, name: str) -> MethodType: ...
@@ -33,12 +82,28 @@ class Class(ClassInterface):
         attrs: list[AttrType],
         constructor: ClassConstructor,
         methods: dict[str, MethodType] = {},
+        inline: bool = False,
     ) -> None:
         self.name = name
-        self._bases = bases
+        self._bases: Sequence[ClassInterface] = []
         self._attrs = attrs
         self.constructor = constructor
         self.methods = methods
+        self.subclasses: weakref.WeakSet[Class] = weakref.WeakSet()
+        self._method_table: Optional[dict[str, MethodType]] = None
+        self._public_table: Optional[dict[str, MethodType]] = None
+        self._attr_table: Optional[dict[str, AttrType]] = None
+        self._resolved_methods: Optional[dict[str, MethodType]] = None
+        self._layout: Optional[dict[str, int]] = None
+        self._default_slots: Optional[list[Any]] = None
+        self._index_table: Optional[dict[str, list[Any]]] = None
+        # このクラスで作った属性の索引。サブクラスにも引き継がれる
+        self.indexes: dict[str, list[Any]] = {}
+        self.version = 0
+        self.storage: Optional[InstanceStorage] = None
+        # inline なクラスのメソッドはスコープを作らず、呼び出し元のスコープで動く
+        self.inline = inline
+        self.bases = bases
 
     @property
     def bases(self) -> Sequence[ClassInterface]:
@@ -46,7 +111,14 @@ class Class(ClassInterface):
 
     @bases.setter
     def bases(self, bases: Sequence[ClassInterface]) -> None:
+        for base in self._bases:
+            if isinstance(base, Class):
+                base.subclasses.discard(self)
         self._bases = bases
+        for base in self._bases:
+            if isinstance(base, Class):
+                base.subclasses.add(self)
+        self.invalidate()
 
     @property
     def attrs(self) -> list[AttrType]:
@@ -55,6 +127,113 @@ class Class(ClassInterface):
     @attrs.setter
     def attrs(self, attrs: list[AttrType]) -> None:
         self._attrs = attrs
+        self.invalidate()
+
+    def built(self, name: str) -> Any:
+        # テーブルがまだ無ければロックを取り、全てのテーブルをまとめて作る
+        with tables_lock:
+            if getattr(self, name) is None:
+                self.build_tables()
+            return getattr(self, name)
+
+    @property
+    def method_table(self) -> dict[str, MethodType]:
+        value = self._method_table
+        return self.built("_method_table") if value is None else value
+
+    @property
+    def public_table(self) -> dict[str, MethodType]:
+        # 外からのメッセージで呼べるメソッドだけの表
+        value = self._public_table
+        return self.built("_public_table") if value is None else value
+
+    @property
+    def index_table(self) -> dict[str, list[Any]]:
+        value = self._index_table
+        return self.built("_index_table") if value is None else value
+
+    @property
+    def attr_table(self) -> dict[str, AttrType]:
+        value = self._attr_table
+        return self.built("_attr_table") if value is None else value
+
+    @property
+    def resolved_methods(self) -> dict[str, MethodType]:
+        value = self._resolved_methods
+        return self.built("_resolved_methods") if value is None else value
+
+    @property
+    def layout(self) -> dict[str, int]:
+        value = self._layout
+        return self.built("_layout") if value is None else value
+
+    @property
+    def default_slots(self) -> list[Any]:
+        value = self._default_slots
+        return self.built("_default_slots") if value is None else value
+
+    def build_tables(self) -> None:
+        with tables_lock:
+            # 自クラスを優先し、基底クラスは定義順に深さ優先で探索する
+            # 継承したものも含めて、メソッドはアクセサより優先される
+            attrs: dict[str, AttrType] = {}
+            for attr in self.attrs:
+                attrs.setdefault(attr.name, attr)
+            methods = dict(self.methods)
+            indexes = {name: list(found) for name, found in self.indexes.items()}
+            for base in self.bases:
+                for name, attr in base.attr_table.items():
+                    attrs.setdefault(name, attr)
+                for name, method in base.resolved_methods.items():
+                    methods.setdefault(name, method)
+                for name, found in base.index_table.items():
+                    merged = indexes.setdefault(name, [])
+                    merged.extend(index for index in found if index not in merged)
+            defaults = self.get_default_attr()
+            layout = {name: index for index, name in enumerate(defaults)}
+            table: dict[str, MethodType] = {}
+            for attr in attrs.values():
+                getter, setter = build_getter_setter(
+                    attr, layout[attr.name], indexes.get(attr.name)
+                )
+                table[f"get-{attr.name}"] = getter
+                table[f"set-{attr.name}"] = setter
+            table.update(methods)
+            self._attr_table = attrs
+            self._resolved_methods = methods
+            self._method_table = table
+            self._public_table = {
+                name: method
+                for name, method in table.items()
+                if not isinstance(method, PrivateMethod)
+            }
+            self._layout = layout
+            self._default_slots = list(defaults.values())
+            self._index_table = indexes
+
+    def invalidate(self) -> None:
+        with tables_lock:
+            self.version += 1
+            self._method_table = None
+            self._public_table = None
+            self._attr_table = None
+            self._resolved_methods = None
+            self._layout = None
+            self._default_slots = None
+            self._index_table = None
+            for subclass in list(self.subclasses):
+                subclass.invalidate()
+
+    def family(self) -> list["Class"]:
+        # 自身と、直接・間接に継承している全てのクラス
+        family: dict[int, Class] = {}
+        pending = [self]
+        while pending:
+            _class = pending.pop()
+            if id(_class) not in family:
+                family[id(_class)] = _class
+                pending.extend(_class.subclasses)
+        return list(family.values())
 
     def get_default_attr(self) -> dict[str, AttrType]:
         attrs = {}
@@ -65,15 +244,12 @@ class Class(ClassInterface):
         return attrs
 
     def find_method(self, name: str) -> Iterable[MethodType]:
-        if name in self.methods:
-            yield self.methods[name]
-            return
-        for base in self.bases:
-            for f in base.find_method(name):
-                yield f
-                return
+        method = self.method_table.get(name)
+        if method is not None:
+            yield method
 
     def get_method(self, name: str) -> MethodType:
-        for f in self.find_method(name):
-            return f
-        raise MethodNotFound(f"{name} not found")
+        method = self.method_table.get(name)
+        if method is None:
+            raise MethodNotFound(f"{name} not found")
+        return method
@@ -1,14 +1,43 @@
-from typing import Sequence
+import threading
+import weakref
+from collections import ChainMap
+from typing import Callable, MutableMapping, Optional, Sequence
 from class_definitions import Class, ClassInterface, ClassConstructor
 from attr_accessor import AttrType
 from method_accessor import MethodType
 
+Relayout = Callable[[dict[Class, dict[str, int]]], None]
+
 
 class ClassManagement:
-    classes: dict[str, Class]
+    classes: MutableMapping[str, Class]
 
     def __init__(self) -> None:
         self.classes = {}
+        self.local: dict[str, Class] = self.classes
+        self.lock = threading.Lock()
+        # 組み込みクラスは名前だけ登録しておき、最初に使われた時に定義する
+        self.lazy: dict[str, Callable[[], None]] = {}
+        self.builtins: MutableMapping[str, Class] = {}
+        self.materialize_lock = threading.RLock()
+        # forkした子は親のクラスを書き換えず、複製して自分のものにする
+        self.parent: Optional[ClassManagement] = None
+        self.owned: weakref.WeakSet[Class] = weakref.WeakSet()
+        self.clones: dict[Class, Class] = {}
+        self.origins: dict[Class, Class] = {}
+        self.on_clone: Optional[Callable[[Class, Class], None]] = None
+        # 基底クラスの再定義で属性の並びが変わったクラスと、元の並びを知らせる
+        self.on_relayout: Optional[Relayout] = None
+
+    def fork(self) -> "ClassManagement":
+        child = ClassManagement()
+        child.parent = self
+        child.classes = ChainMap(child.local, self.classes)
+        child.builtins = ChainMap({}, self.builtins)
+        return child
+
+    def owns(self, _class: Class) -> bool:
+        return _class in self.owned
 
     def define(
         self,
@@ -17,8 +46,107 @@ class ClassManagement:
         attrs: list[AttrType],
         constructor: ClassConstructor,
         methods: dict[str, MethodType],
+        inline: bool = False,
     ) -> None:
-        self.classes[name] = Class(name, bases, attrs, constructor, methods)
+        with self.lock:
+            self.lazy.pop(name, None)
+            bases = self.owned_bases(bases)
+            _class = Class(name, bases, attrs, constructor, methods, inline)
+            previous = self.classes.get(name)
+            self.classes[name] = _class
+            self.owned.add(_class)
+            if previous is not None:
+                self.rebase(previous, _class)
+            _class.build_tables()
+
+    def rebase(self, previous: Class, _class: Class) -> None:
+        # 再定義されたクラスを継承しているクラスは新しい定義へ付け替える
+        # 親から見えているだけのクラスは複製してから付け替える
+        for subclass in list(previous.subclasses):
+            if subclass is _class:
+                continue
+            bases = [_class if base is previous else base for base in subclass.bases]
+            if self.owns(subclass):
+                layouts = {c: c.layout for c in subclass.family()}
+                subclass.bases = bases
+                if self.on_relayout is not None:
+                    self.on_relayout(layouts)
+            elif self.classes.get(subclass.name) is subclass:
+                self.clone(subclass, bases)
+
+    def owned_bases(self, bases: Sequence[ClassInterface]) -> list[ClassInterface]:
+        # 親のクラスを継承する前に複製し、親のクラスの subclasses に子のクラスを繋がない
+        # 組み込みクラスは親と共有する
+        owned: list[ClassInterface] = []
+        for base in bases:
+            if isinstance(base, Class) and self.parent is not None:
+                base = self.clones.get(base, base)
+                if (
+                    not self.owns(base)
+                    and self.builtins.get(base.name) is not base
+                    and self.classes.get(base.name) is base
+                ):
+                    base = self.clone(base, base.bases)
+            owned.append(base)
+        return owned
+
+    def clone(self, _class: Class, bases: Sequence[ClassInterface]) -> Class:
+        bases = self.owned_bases(bases)
+        # 基底クラスを複製した時に、このクラスも一緒に複製されていることがある
+        if _class in self.clones:
+            return self.clones[_class]
+        clone = Class(
+            _class.name,
+            bases,
+            _class.attrs,
+            _class.constructor,
+            _class.methods,
+            _class.inline,
+        )
+        self.local[_class.name] = clone
+        self.owned.add(clone)
+        self.clones[_class] = clone
+        self.origins[clone] = _class
+        if self.on_clone is not None:
+            self.on_clone(_class, clone)
+        self.rebase(_class, clone)
+        return clone
+
+    def own(self, name: str) -> Class:
+        # 子で変更する前に、親のクラスを自分のものにしておく
+        _class = self.get_class(name)
+        if self.owns(_class):
+            return _class
+        with self.lock:
+            return self.clone(_class, _class.bases)
+
+    def origin(self, _class: Class) -> Class:
+        return self.origins.get(_class, _class)
+
+    def resolve(self, _class: Class) -> Class:
+        # 親の世界のクラスを、子で複製したものがあればそれに置き換える
+        if self.parent is not None:
+            _class = self.parent.resolve(_class)
+        return self.clones.get(_class, _class)
+
+    def register_lazy(self, name: str, materialize: Callable[[], None]) -> None:
+        self.lazy[name] = materialize
+
+    def materialize(self, name: str) -> Class:
+        with self.materialize_lock:
+            _class = self.classes.get(name)
+            if _class is not None:
+                return _class
+            materialize = self.lazy[name]
+            materialize()
+            _class = self.classes[name]
+            self.builtins[name] = _class
+            return _class
 
     def get_class(self, name: str) -> Class:
-        return self.classes[name]
+        try:
+            return self.classes[name]
+        except KeyError:
+            if name not in self.lazy:
+                raise
+            return self.materialize(name)
@@ -0,0 +1,248 @@
+import mmap
+import os
+import threading
+import weakref
+from typing import (
+    Any,
+    Iterable,
+    Iterator,
+    Literal,
+    MutableSequence,
+    Optional,
+    Sequence,
+)
+from class_definitions import Class
+from environment import Environment
+
+Typecode = Literal["b", "B", "h", "H", "i", "I", "l", "L", "q", "Q", "f", "d"]
+TYPECODES: dict[type, Typecode] = {int: "q", float: "d"}
+
+
+class Column:
+    # bytearray か mmap したファイルを memoryview で型付きの配列として扱う
+    # None は数値の列に入らないので、行ごとの null の印を別に持つ
+    def __init__(self, typecode: Typecode, capacity: int, path: Optional[str]) -> None:
+        self.typecode = typecode
+        self.itemsize = memoryview(bytes(8)).cast(typecode).itemsize
+        self.path = path
+        self.file: Any = None
+        self.buffer: Any = None
+        self.view: memoryview[Any] = memoryview(b"")
+        self.nulls = bytearray()
+        self.capacity = 0
+        if path is not None:
+            self.file = open(path, "a+b")
+        self.resize(capacity)
+
+    def resize(self, capacity: int) -> None:
+        # column() で渡した参照が元の領域を掴んでいても広げられるよう、
+        # その場で伸ばさずに新しい領域を確保して中身を移す
+        # 古い領域は参照が全て無くなった時に解放される
+        size = capacity * self.itemsize
+        buffer: bytearray | mmap.mmap
+        if self.file is None:
+            buffer = bytearray(size)
+            if self.buffer is not None:
+                used = min(len(self.buffer), size)
+                buffer[:used] = self.buffer[:used]
+        else:
+            if os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+            buffer = mmap.mmap(self.file.fileno(), size)
+        self.buffer = buffer
+        self.view = memoryview(buffer).cast(self.typecode)
+        nulls = bytearray(capacity)
+        used = min(len(self.nulls), capacity)
+        nulls[:used] = self.nulls[:used]
+        self.nulls = nulls
+        self.capacity = capacity
+
+    def restore(self, data: bytes) -> None:
+        # 保存したバイト列をそのまま書き戻すので、型付きの view に変換しない
+        self.buffer[: len(data)] = data
+
+    def close(self) -> None:
+        self.view.release()
+        if self.file is not None:
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+
+class ColumnStore:
+    # クラスの数値属性を列ごとに連続した領域へ格納する
+    # インスタンスは行番号を持つだけの RowSlots になる
+    def __init__(
+        self,
+        class_type: Class,
+        environment: Environment,
+        columns: dict[str, Any],
+        path: Optional[str] = None,
+        capacity: int = 1024,
+    ) -> None:
+        self.class_type = class_type
+        self.environment = environment
+        self.columns: dict[str, Column] = {}
+        for name, typecode in columns.items():
+            if name not in class_type.layout:
+                raise KeyError(f"{class_type.name} has no attribute {name}")
+            column_path = None if path is None else f"{path}.{name}.col"
+            typecode = TYPECODES.get(typecode, typecode)
+            self.columns[name] = Column(typecode, capacity, column_path)
+        self.size = 0
+        self.rows: list[RowRef] = []
+        self.dead: list[RowRef] = []
+        self.reclaimed = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self._layout: dict[str, int] = {}
+        self._by_slot: list[Optional[Column]] = []
+
+    @property
+    def by_slot(self) -> list[Optional[Column]]:
+        # クラスが変更されて属性の並びが変わったら対応を作り直す
+        layout = self.class_type.layout
+        if layout is not self._layout:
+            self._by_slot = [self.columns.get(name) for name in layout]
+            self._layout = layout
+        return self._by_slot
+
+    def new_slots(self) -> "RowSlots":
+        self.compact()
+        with self.lock:
+            if self.size == self.capacity:
+                self.grow(self.capacity * 2)
+            row = self.size
+            self.size += 1
+            slots = RowSlots(self, row)
+            self.rows.append(RowRef(slots, self.dead.append, row))
+        for index, value in enumerate(self.class_type.default_slots):
+            slots[index] = value
+        return slots
+
+    def adopt(self, values: Iterable[Any]) -> "RowSlots":
+        # 列ストアを作る前からあるインスタンスのスロットを行に移す
+        slots = self.new_slots()
+        for index, value in enumerate(values):
+            slots[index] = value
+        return slots
+
+    def relayout(self, slots: Sequence[Any], layout: dict[str, int]) -> None:
+        # 列の値は属性名で引くのでそのまま使え、列以外の値だけを並べ直す
+        assert isinstance(slots, RowSlots)
+        extra = slots.extra
+        migrated = list(self.class_type.default_slots)
+        for name, index in self.class_type.layout.items():
+            if name in layout and layout[name] < len(extra):
+                migrated[index] = extra[layout[name]]
+        slots.extra = migrated
+
+    def compact(self) -> int:
+        # 解放された行に末尾の行を移して、生きている行を先頭に詰めておく
+        # 行の参照が消えたときはコールバックで dead に積むだけにして、
+        # 移動はここでまとめて行う
+        if not self.dead or self.closed:
+            return 0
+        count = 0
+        with self.lock:
+            while self.dead:
+                ref = self.dead.pop()
+                row = ref.row
+                last = self.size - 1
+                if row != last:
+                    for column in self.columns.values():
+                        column.view[row] = column.view[last]
+                        column.nulls[row] = column.nulls[last]
+                    moved = self.rows[last]
+                    moved.row = row
+                    slots = moved()
+                    if slots is not None:
+                        slots.row = row
+                    self.rows[row] = moved
+                self.rows.pop()
+                self.size = last
+                count += 1
+            self.reclaimed += count
+        return count
+
+    @property
+    def capacity(self) -> int:
+        return min((c.capacity for c in self.columns.values()), default=0)
+
+    def grow(self, capacity: int) -> None:
+        for column in self.columns.values():
+            column.resize(max(capacity, 1))
+
+    def column(self, name: str) -> memoryview:
+        # 行数分だけを切り出した、コピーしない列の参照
+        self.compact()
+        return self.columns[name].view[: self.size]
+
+    def close(self) -> None:
+        self.closed = True
+        for column in self.columns.values():
+            column.close()
+
+    def read(self, column: Column, row: int) -> Any:
+        if column.nulls[row]:
+            return None
+        return self.environment.new_tmp_primitive(column.view[row])
+
+    def write(self, column: Column, row: int, value: Any) -> None:
+        if value is None:
+            column.view[row] = 0
+            column.nulls[row] = 1
+            return
+        raw = self.environment.unbox_primitive(value)
+        if raw is None:
+            raise TypeError(f"{value!r} cannot be stored in a numeric column")
+        column.view[row] = raw
+        column.nulls[row] = 0
+
+
+class RowRef(weakref.ref["RowSlots"]):
+    # 行の移動に追従できるよう、弱参照自体に現在の行番号を持たせる
+    # 弱参照の作成は __new__ で済むので、__init__ では行番号だけを持つ
+    __slots__ = ("row",)
+
+    def __init__(self, slots: "RowSlots", callback: Any, row: int) -> None:
+        self.row = row
+
+    def __new__(cls, slots: "RowSlots", callback: Any, row: int) -> "RowRef":
+        return super().__new__(cls, slots, callback)
+
+
+class RowSlots(MutableSequence[Any]):
+    __slots__ = ("store", "row", "extra", "__weakref__")
+
+    def __init__(self, store: ColumnStore, row: int) -> None:
+        self.store = store
+        self.row = row
+        self.extra: list[Any] = [None] * len(store.class_type.layout)
+
+    def __getitem__(self, index: Any) -> Any:
+        column = self.store.by_slot[index]
+        if column is None:
+            return self.extra[index] if index < len(self.extra) else None
+        return self.store.read(column, self.row)
+
+    def __setitem__(self, index: Any, value: Any) -> None:
+        column = self.store.by_slot[index]
+        if column is None:
+            if index >= len(self.extra):
+                self.extra.extend([None] * (index + 1 - len(self.extra)))
+            self.extra[index] = value
+        else:
+            self.store.write(column, self.row, value)
+
+    def __delitem__(self, index: Any) -> None:
+        raise TypeError("slots cannot be deleted")
+
+    def __len__(self) -> int:
+        return len(self.store.by_slot)
+
+    def __iter__(self) -> Iterator[Any]:
+        return (self[index] for index in range(len(self)))
+
+    def insert(self, index: int, value: Any) -> None:
+        raise TypeError("slots cannot be inserted")
@@ -0,0 +1,121 @@
+from types import CodeType, FunctionType
+from typing import TYPE_CHECKING, Any, Callable
+from attr_accessor import AttrGetter, AttrSetter
+from class_definitions import Class, MessageType
+from exceptions import MethodNotFound
+from instance import Instance
+from method_accessor import MethodType
+
+if TYPE_CHECKING:
+    from environment import Environment
+    from oos import ObjectOrientedSystem as System
+
+Step = Callable[["MessageFrame", dict[str, MessageType]], Any]
+
+
+def sent_names(code: CodeType) -> set[str]:
+    # メソッド本体(入れ子のlambdaも含む)に現れる文字列定数をメソッド名の候補とする
+    names = set()
+    for const in code.co_consts:
+        if isinstance(const, str):
+            names.add(const)
+        elif isinstance(const, CodeType):
+            names |= sent_names(const)
+    return names
+
+
+def compile_step(func: MethodType) -> Step:
+    accessor = func.method
+    if type(accessor) is AttrGetter:
+        return lambda frame, argv: accessor.get(frame.this)
+    if type(accessor) is AttrSetter:
+
+        def set_attr(frame: MessageFrame, argv: dict[str, MessageType]) -> None:
+            if "value" not in argv:
+                raise MethodNotFound("get-value")
+            accessor.set(frame.this, frame.system.convert_value(argv["value"]))
+
+        return set_attr
+    return lambda frame, argv: frame.system.invoke(
+        frame.this, func, frame.system.instantiate_argv(argv)
+    )
+
+
+class CallPlan:
+    __slots__ = ("table", "steps")
+
+    def __init__(self, class_type: Class, names: set[str]) -> None:
+        self.table = class_type.method_table
+        self.steps: dict[str, Step] = {}
+        for name in names:
+            self.get_step(name)
+
+    def get_step(self, name: str) -> Step | None:
+        step = self.steps.get(name)
+        if step is None:
+            func = self.table.get(name)
+            if func is None:
+                return None
+            step = self.steps[name] = compile_step(func)
+        return step
+
+
+class MessageFrame:
+    # コンパイル済みメソッドの本体に sys の代わりに渡される
+    # this と args は名前解決せずに直接参照し、this へのメッセージは事前に解決した手順で実行する
+    __slots__ = ("system", "this", "args", "plan")
+
+    def __init__(
+        self, system: "System", this: Instance, args: Instance, plan: CallPlan
+    ) -> None:
+        self.system = system
+        self.this = this
+        self.args = args
+        self.plan = plan
+
+    @property
+    def environment(self) -> "Environment":
+        return self.system.environment
+
+    def send(
+        self, instance_name: str | Instance, method: str, **argv: MessageType
+    ) -> Any:
+        if instance_name == "this":
+            step = self.plan.get_step(method)
+            if step is not None:
+                return step(self, argv)
+        elif instance_name == "args" and not argv and method.startswith("get-"):
+            attributes = self.args.attributes
+            if method[4:] in attributes:
+                return attributes[method[4:]]
+        return self.system.send(instance_name, method, **argv)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.system, name)
+
+
+class CompiledMethod:
+    __slots__ = ("body", "names", "plans")
+
+    def __init__(self, body: Callable[..., Any]) -> None:
+        self.body = body
+        self.names = sent_names(body.__code__)
+        self.plans: dict[Class, CallPlan] = {}
+
+    def plan_for(self, class_type: Class) -> CallPlan:
+        # クラスや基底クラスが再定義されるとメソッドテーブルが作り直されるので、計画も作り直す
+        plan = self.plans.get(class_type)
+        if plan is None or plan.table is not class_type.method_table:
+            plan = self.plans[class_type] = CallPlan(class_type, self.names)
+        return plan
+
+    def __call__(self, sys: "System") -> Any:
+        this = sys.environment.get_instance("this")
+        args = sys.environment.get_instance("args")
+        return self.body(MessageFrame(sys, this, args, self.plan_for(this.class_type)))
+
+
+def compile_method(func: MethodType) -> MethodType:
+    if not isinstance(func.method, FunctionType):
+        return func
+    return type(func)(CompiledMethod(func.method))
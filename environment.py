@@ -1,27 +1,60 @@
+import gc
 import operator
-from typing import Any
+from functools import partial
+from typing import TYPE_CHECKING, Any, Callable, Optional
 from attr_accessor import AttrType, PublicAttr
-from class_definitions import ClassConstructor, MessageType
+from class_definitions import Class, ClassConstructor, MessageType, no_constructor
 from class_management import ClassManagement
-from instance import Instance
+from instance import Arguments, Instance
 from instance_management import InstanceManagement
 from method_accessor import MethodType, PublicMethod
+from primitive_cache import PrimitiveCache, is_shared
+
+if TYPE_CHECKING:
+    from oos import ObjectOrientedSystem as System
 
 
 class Environment:
     def __init__(self) -> None:
         self.class_definitions = ClassManagement()
         self.instance_management = InstanceManagement()
+        self.class_definitions.on_relayout = self.instance_management.relayout
 
         self.primitive_types = [int, float]
-
-        define_primitive(self)
-
+        self.primitive_classes: set[Class] = set()
+        self.primitive_cache = PrimitiveCache()
+        self.register_builtins()
+
+    def register_builtins(self) -> None:
+        classes = self.class_definitions
+        classes.register_lazy("args", partial(define_arguments, self))
+        classes.register_lazy("primitive", partial(define_primitive, self))
         for t in self.primitive_types:
-            define_primitive_type(self, t)
+            classes.register_lazy(t.__name__, partial(define_primitive_type, self, t))
+
+    def fork(self) -> "Environment":
+        # クラスとインスタンスの表は親と共有し、子で変更した分だけを子が持つ
+        child = Environment.__new__(Environment)
+        child.class_definitions = self.class_definitions.fork()
+        child.instance_management = self.instance_management.fork(
+            child.class_definitions
+        )
+        child.primitive_types = self.primitive_types
+        child.primitive_classes = set(self.primitive_classes)
+        child.primitive_cache = PrimitiveCache()
+        child.register_builtins()
+        return child
 
     def is_primitive(self, value: Any) -> bool:
-        return any(isinstance(value, t) for t in self.primitive_types)
+        # boolはintのサブクラスだが、対応するクラスが無いのでそのまま扱う
+        return type(value) in self.primitive_types
+
+    def unbox_primitive(self, value: Any) -> Optional[Any]:
+        if type(value) in self.primitive_types:
+            return value
+        if isinstance(value, Instance) and value.class_type in self.primitive_classes:
+            return value.get_attribute("value")
+        return None
 
     def define(
         self,
@@ -30,27 +63,67 @@ class Environment:
         attrs: list[AttrType],
         constructor: ClassConstructor,
         methods: dict[str, MethodType],
+        inline: bool = False,
     ) -> None:
         base_classes = [self.class_definitions.get_class(base) for base in bases]
-        self.class_definitions.define(name, base_classes, attrs, constructor, methods)
+        self.class_definitions.define(
+            name, base_classes, attrs, constructor, methods, inline
+        )
 
     def new(self, cls: str, name: str) -> Instance:
         _class = self.class_definitions.get_class(cls)
         instance = self.instance_management.make_instance(_class, name)
         return instance
 
-    def new_tmp_primitive(self, value: Any) -> Instance:
+    def new_tmp_primitive(self, value: Any, literal: bool = False) -> Instance:
+        # 一時的な数値は共有される箱なので、書き換えると別の箱になる
         cls = self.class_definitions.get_class(type(value).__name__)
-        instance = Instance.new_from_class(cls)
-        instance.attributes["value"] = value
-        return instance
+        return self.primitive_cache.box(cls, value, literal)
+
+    def new_arguments(self, argv: dict[str, Any]) -> Instance:
+        return Arguments(self.class_definitions.get_class("args"), argv)
 
     def get_instance(self, instance_name: str) -> Instance:
         return self.instance_management.get_instance(instance_name)
 
+    def delete(self, name: str) -> None:
+        self.instance_management.delete(name)
+
+    def live_instances(self) -> int:
+        return self.instance_management.live()
+
+    def sweep(self) -> dict[str, int]:
+        # 循環参照で残ったインスタンスを回収し、引数のアクセサのキャッシュと
+        # 列ストアの空いた行も片付ける
+        live = self.live_instances()
+        getters = len(Arguments.getters)
+        Arguments.getters.clear()
+        gc.collect()
+        rows = 0
+        for _class in list(self.class_definitions.local.values()):
+            if _class.storage is not None:
+                rows += _class.storage.compact()
+        swept = {
+            "instances": live - self.live_instances(),
+            "getters": getters,
+            "rows": rows,
+        }
+        self.instance_management.reclaimed["swept"] += swept["instances"]
+        return swept
+
+    def reclaimed(self) -> dict[str, int]:
+        rows = sum(
+            getattr(_class.storage, "reclaimed", 0)
+            for _class in list(self.class_definitions.local.values())
+        )
+        return {**self.instance_management.reclaimed, "rows": rows}
+
     def register_instance(self, name: str, instance: Instance) -> None:
         self.instance_management.register_instance(name, instance)
 
+    def bind(self, name: str, instance: Instance) -> None:
+        self.instance_management.bind(name, instance)
+
     def __enter__(self) -> None:
         self.instance_management.push()
 
@@ -58,22 +131,62 @@ class Environment:
         self.instance_management.pop()
 
 
+def get_or_fallback(sys: "System") -> Any:
+    attr = sys.send("args", "get-attr")
+    if attr in sys.environment.get_instance("this").attributes:
+        return sys.send("this", "get-" + attr)
+    return sys.send("args", "get-fallback")
+
+
+ARGUMENTS_METHODS: dict[str, MethodType] = {"get": PublicMethod(get_or_fallback)}
+
+
+def define_arguments(env: Environment) -> None:
+    env.define("args", [], [], no_constructor, dict(ARGUMENTS_METHODS))
+
+
+def set_value(sys: "System") -> Instance:
+    # 属性に入れた箱は共有されていないので、その場で書き換える
+    # 共有された一時的な箱は書き換えると他の値まで変わってしまうので拒む
+    this = sys.environment.get_instance("this")
+    if is_shared(this):
+        raise TypeError("a shared primitive box cannot be modified")
+    value = sys.send(sys.send("args", "get-value"), "get-value")
+    this.set_attribute("value", value)
+    return this
+
+
 def define_primitive(env: Environment):
     env.define(
         "primitive",
         [],
         [PublicAttr("value")],
-        lambda sys: None,
-        {
-            "set-value": PublicMethod(
-                lambda sys: sys.environment.get_instance("this").attributes.update(
-                    value=sys.send(sys.send("args", "get-value"), "get-value")
-                )
-            ),
-        },
+        no_constructor,
+        {"set-value": PublicMethod(set_value)},
     )
 
 
+PRIMITIVE_OPERATIONS: dict[str, Callable[[Any, Any], Any]] = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "multiply": operator.mul,
+    "max": max,
+}
+
+
+class PrimitiveOperation:
+    def __init__(self, operation: Callable[[Any, Any], Any]) -> None:
+        self.operation = operation
+
+    def __call__(self, sys: "System") -> Instance:
+        return sys.environment.new_tmp_primitive(
+            self.operation(
+                sys.send("this", "get-value"),
+                sys.send(sys.send("args", "get-value"), "get-value"),
+            )
+        )
+
+
 def define_primitive_type(env: Environment, cls: type) -> None:
     env.define(
         cls.__name__,
@@ -81,37 +194,8 @@ def define_primitive_type(env: Environment, cls: type) -> None:
         [PublicAttr("value")],
         lambda sys: sys.send("this", "set-value", value=sys.send("args", "get-value")),
         {
-            "add": PublicMethod(
-                lambda sys: env.new_tmp_primitive(
-                    operator.add(
-                        sys.send("this", "get-value"),
-                        sys.send(sys.send("args", "get-value"), "get-value"),
-                    )
-                )
-            ),
-            "sub": PublicMethod(
-                lambda sys: env.new_tmp_primitive(
-                    operator.sub(
-                        sys.send("this", "get-value"),
-                        sys.send(sys.send("args", "get-value"), "get-value"),
-                    )
-                )
-            ),
-            "multiply": PublicMethod(
-                lambda sys: env.new_tmp_primitive(
-                    operator.mul(
-                        sys.send("this", "get-value"),
-                        sys.send(sys.send("args", "get-value"), "get-value"),
-                    )
-                )
-            ),
-            "max": PublicMethod(
-                lambda sys: env.new_tmp_primitive(
-                    max(
-                        sys.send("this", "get-value"),
-                        sys.send(sys.send("args", "get-value"), "get-value"),
-                    )
-                )
-            ),
+            name: PublicMethod(PrimitiveOperation(operation))
+            for name, operation in PRIMITIVE_OPERATIONS.items()
         },
     )
+    env.primitive_classes.add(env.class_definitions.get_class(cls.__name__))
@@ -4,3 +4,7 @@ class MethodAccessDenied(Exception):
 
 class MethodNotFound(Exception):
     pass
+
+
+class SnapshotError(Exception):
+    pass
@@ -1,63 +1,130 @@
-from attr_accessor import AttrType, PrivateAttr, PublicAttr, ReadonlyAttr
-from class_definitions import Class, ClassInterface
-from typing import Any, Iterable
-from exceptions import MethodNotFound
-from method_accessor import MethodType, PrivateMethod, PublicMethod
+from collections.abc import MutableMapping
+from attr_accessor import AttrGetter, unshare
+from class_definitions import Class
+from typing import Any, Iterator, MutableSequence, Sequence, cast
+from exceptions import MethodAccessDenied, MethodNotFound
+from method_accessor import MethodType, PublicMethod
+from undo_log import current_log
 
 
 class Instance:
-    def __init__(self, class_type: Class, attributes: dict[str, Any]) -> None:
+    __slots__ = ("class_type", "slots", "__weakref__")
+
+    def __init__(self, class_type: Class, slots: Sequence[Any]) -> None:
+        # キャッシュで共有される数値の箱は、書き換えられないタプルをスロットに持つ
         self.class_type = class_type
-        self.attributes = attributes
+        self.slots = slots
+
+    @property
+    def attributes(self) -> "SlotAttributes":
+        return SlotAttributes(self)
+
+    def get_attribute(self, name: str) -> Any:
+        return self.slots[self.class_type.layout[name]]
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        index = self.class_type.layout[name]
+        log = current_log.get()
+        if log is not None:
+            log.record(self.slots, index)
+        cast(MutableSequence[Any], self.slots)[index] = unshare(value)
 
     def get_method(self, name: str) -> Any:
-        for f in self.class_type.find_method(name):
-            return f
-        for f in find_attr_functions(self, self.class_type, name):
-            return f
-        raise MethodNotFound(name)
+        method = self.class_type.method_table.get(name)
+        if method is None:
+            raise MethodNotFound(name)
+        return method
 
-    @staticmethod
-    def new_from_class(class_type: Class) -> "Instance":
-        return Instance(class_type, class_type.get_default_attr())
-
-
-def find_attr_functions(
-    instance: Instance, class_type: ClassInterface, name: str
-) -> Iterable[MethodType]:
-    for attr in class_type.attrs:
-        getter, setter = build_getter_setter(instance, attr)
-        getter_name = f"get-{attr.name}"
-        setter_name = f"set-{attr.name}"
-        if name == getter_name:
-            yield getter
-            return
-        elif name == setter_name:
-            yield setter
+    def get_public_method(self, name: str) -> Any:
+        method = self.class_type.public_table.get(name)
+        if method is None:
+            if name in self.class_type.method_table:
+                raise MethodAccessDenied(f"{name} is PrivateMethod")
+            raise MethodNotFound(name)
+        return method
+
+    def migrate(self, layout: dict[str, int]) -> None:
+        # 古い属性の並びで作られたスロットを、属性名で今の並びへ移す
+        _class = self.class_type
+        slots = self.slots
+        if _class.layout == layout or type(slots) is tuple:
             return
-    for base in class_type.bases:
-        for f in find_attr_functions(instance, base, name):
-            yield f
+        if type(slots) is not list:
+            assert _class.storage is not None
+            _class.storage.relayout(slots, layout)
             return
+        migrated = list(_class.default_slots)
+        for name, index in _class.layout.items():
+            if name in layout:
+                migrated[index] = slots[layout[name]]
+        slots[:] = migrated
+
+    @staticmethod
+    def new_from_class(class_type: Class) -> "Instance":
+        storage = class_type.storage
+        if storage is not None:
+            return Instance(class_type, storage.new_slots())
+        return Instance(class_type, list(class_type.default_slots))
+
+
+class SlotAttributes(MutableMapping[str, Any]):
+    __slots__ = ("instance",)
 
+    def __init__(self, instance: Instance) -> None:
+        self.instance = instance
+
+    def __getitem__(self, name: str) -> Any:
+        return self.instance.slots[self.instance.class_type.layout[name]]
+
+    def __setitem__(self, name: str, value: Any) -> None:
+        self.instance.set_attribute(name, value)
+
+    def __delitem__(self, name: str) -> None:
+        raise TypeError(f"{name} cannot be deleted")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.instance.class_type.layout)
+
+    def __len__(self) -> int:
+        return len(self.instance.class_type.layout)
+
+
+class Arguments(Instance):
+    # 引数は呼び出しごとに名前が変わるので、スロットではなくdictで持つ
+    __slots__ = ("attributes",)
+    getters: dict[str, MethodType] = {}
+
+    def __init__(self, class_type: Class, attributes: dict[str, Any]) -> None:
+        self.class_type = class_type
+        self.attributes = attributes  # type: ignore[misc,assignment]
+
+    def get_attribute(self, name: str) -> Any:
+        return self.attributes[name]
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        self.attributes[name] = value
+
+    def get_method(self, name: str) -> Any:
+        method = self.class_type.method_table.get(name)
+        if method is not None:
+            return method
+        if name.startswith("get-") and name[4:] in self.attributes:
+            return argument_getter(name[4:])
+        raise MethodNotFound(name)
 
-def build_getter_setter(
-    this: Instance, attr: AttrType
-) -> tuple[MethodType, MethodType]:
-    from oos import ObjectOrientedSystem as System
+    get_public_method = get_method
 
-    def getter(sys: System) -> Any:
-        return this.attributes[attr.name]
 
-    def setter(sys: System) -> None:
-        this.attributes[attr.name] = sys.send("args", "get-value")
+class ArgumentGetter(AttrGetter):
+    __slots__ = ()
 
-    table: dict[type[AttrType], tuple[type[MethodType], type[MethodType]]] = {
-        PublicAttr: (PublicMethod, PublicMethod),
-        PrivateAttr: (PrivateMethod, PrivateMethod),
-        ReadonlyAttr: (PublicMethod, PrivateMethod),
-    }
+    def get(self, this: Any) -> Any:
+        return this.attributes[self.name]
 
-    GetterMethodClass, SetterMethodClass = table[type(attr)]
 
-    return GetterMethodClass(getter), SetterMethodClass(setter)
+def argument_getter(name: str) -> MethodType:
+    getter = Arguments.getters.get(name)
+    if getter is None:
+        getter = PublicMethod(ArgumentGetter(name, -1))
+        Arguments.getters[name] = getter
+    return getter
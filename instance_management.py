@@ -1,30 +1,332 @@
+import threading
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
 from class_definitions import Class
-from typing import Any
+from class_management import ClassManagement
 from instance import Instance
+from attr_accessor import unshare
+from undo_log import current_log
+
+
+class Scope:
+    __slots__ = ("bindings", "frames")
+
+    def __init__(self) -> None:
+        # 名前ごとの束縛のスタックと、スコープごとに登録した名前の記録
+        # pop時は記録した名前の束縛だけを戻すので、深さに依存しない
+        self.bindings: dict[str, list[Instance]] = {}
+        self.frames: list[list[str]] = [[]]
+
+    def bind(self, name: str, instance: Instance) -> None:
+        frame = self.frames[-1]
+        if name in frame:
+            self.bindings[name][-1] = instance
+        else:
+            frame.append(name)
+            self.bindings.setdefault(name, []).append(instance)
+
+    def fork(self) -> "Scope":
+        # 現在見えている束縛だけを引き継いだ新しいスコープを作る
+        scope = Scope()
+        scope.bindings = {name: [stack[-1]] for name, stack in self.bindings.items()}
+        scope.frames = [list(scope.bindings)]
+        return scope
+
+    def push(self) -> None:
+        self.frames.append([])
+
+    def pop(self) -> int:
+        # スコープ内で登録された一時インスタンスの数を返す
+        frame = self.frames.pop()
+        for name in frame:
+            stack = self.bindings[name]
+            stack.pop()
+            if not stack:
+                del self.bindings[name]
+        return len(frame) - ("this" in frame) - ("args" in frame)
+
+    def unbind(self, name: str) -> Optional[Instance]:
+        frame = self.frames[-1]
+        if name not in frame:
+            return None
+        frame.remove(name)
+        stack = self.bindings[name]
+        instance = stack.pop()
+        if not stack:
+            del self.bindings[name]
+        return instance
+
+
+class ScopeTable(dict[Any, Scope]):
+    # コンテキスト(スレッド)ごとの、システムの弱参照からスコープへの表
+    # システムが回収されると弱参照のコールバックで全ての表から消える
+    __slots__ = ("__weakref__",)
+
+
+scope_tables: weakref.WeakValueDictionary[int, ScopeTable] = (
+    weakref.WeakValueDictionary()
+)
+current_scopes: ContextVar[Optional[ScopeTable]] = ContextVar("scopes", default=None)
+
+
+def release_scopes(key: Any) -> None:
+    for table in list(scope_tables.values()):
+        table.pop(key, None)
+
+
+def new_scope_table(scopes: Optional[ScopeTable] = None) -> ScopeTable:
+    table = ScopeTable(scopes or {})
+    scope_tables[id(table)] = table
+    return table
 
 
 class InstanceManagement:
     def __init__(
         self,
     ) -> None:
-        self.instances: list[dict[str, Instance]] = [{}]
+        # トップレベルのインスタンスは全スレッドで共有し、
+        # this や args などのスコープはスレッド(コンテキスト)ごとに持つ
+        self.globals: dict[str, Instance] = {}
+        self.lock = threading.Lock()
+        self.reclaimed = {"deleted": 0, "released": 0, "swept": 0}
+        # クラスごとの生きているインスタンス
+        self.instances: dict[Class, weakref.WeakSet[Instance]] = {}
+        # 消したがまだ参照が残っているインスタンス。sweep で回収した数を数える
+        self.detached: weakref.WeakSet[Instance] = weakref.WeakSet()
+        # forkした子は親のインスタンスを最初に触れた時に複製する
+        self.parent: Optional[InstanceManagement] = None
+        self.class_definitions: Optional[ClassManagement] = None
+        self.copies: dict[Instance, Instance] = {}
+        self.deleted: set[str] = set()
+        self.key = weakref.ref(self, release_scopes)
+
+    def fork(self, class_definitions: ClassManagement) -> "InstanceManagement":
+        child = InstanceManagement()
+        child.parent = self
+        child.class_definitions = class_definitions
+        class_definitions.on_clone = child.retarget
+        class_definitions.on_relayout = child.relayout
+        return child
+
+    def retarget(self, previous: Class, _class: Class) -> None:
+        # 親のクラスを複製したら、子が既に持っているインスタンスも付け替える
+        instances = self.instances.pop(previous, None)
+        if instances is None:
+            return
+        for instance in list(instances):
+            instance.class_type = _class
+            instance.migrate(previous.layout)
+            self.track(instance)
+
+    def relayout(self, layouts: dict[Class, dict[str, int]]) -> None:
+        for _class, layout in layouts.items():
+            for instance in list(self.instances.get(_class, ())):
+                instance.migrate(layout)
+
+    @property
+    def scope(self) -> Scope:
+        scopes = current_scopes.get()
+        if scopes is not None:
+            scope = scopes.get(self.key)
+            if scope is not None:
+                return scope
+        else:
+            scopes = new_scope_table()
+            current_scopes.set(scopes)
+        scope = scopes[self.key] = Scope()
+        return scope
+
+    @contextmanager
+    def forked_scope(self) -> Iterator[None]:
+        # asyncioのタスクはコンテキストを共有しうるので、awaitを挟む呼び出しは
+        # 呼び出しごとに複製したスコープを使う
+        scopes = new_scope_table(current_scopes.get())
+        scopes[self.key] = self.scope.fork()
+        token = current_scopes.set(scopes)
+        try:
+            yield
+        finally:
+            current_scopes.reset(token)
 
     def make_instance(self, _class: Class, instance_name: str) -> Instance:
+        classes = self.class_definitions
+        if classes is not None and _class.storage is not None:
+            # 親のクラスの列ストアには書き込まない
+            if not classes.owns(_class):
+                instance = Instance(_class, list(_class.default_slots))
+                self.track(instance)
+                self.register_instance(instance_name, instance)
+                return instance
         instance = Instance.new_from_class(_class)
-        self.instances[-1][instance_name] = instance
+        self.track(instance)
+        self.register_instance(instance_name, instance)
         return instance
 
+    def track(self, instance: Instance) -> None:
+        instances = self.instances.get(instance.class_type)
+        if instances is None:
+            instances = self.instances.setdefault(
+                instance.class_type, weakref.WeakSet()
+            )
+        instances.add(instance)
+        for indexes in instance.class_type.index_table.values():
+            for index in indexes:
+                index.refresh(instance)
+
+    def untrack(self, instance: Instance) -> None:
+        # 消したインスタンスは検索や一括計算から外し、列ストアの行も手放す
+        instances = self.instances.get(instance.class_type)
+        if instances is None or instance not in instances:
+            return
+        log = current_log.get()
+        if log is not None:
+            log.call(self.retrack, instance)
+        instances.discard(instance)
+        self.detached.add(instance)
+        if type(instance.slots) not in (list, tuple):
+            instance.slots = [unshare(value) for value in instance.slots]
+        for indexes in instance.class_type.index_table.values():
+            for index in indexes:
+                index.refresh(instance)
+
+    def retrack(self, instance: Instance) -> None:
+        # 削除を取り消したら、列ストアの行に戻してから追跡し直す
+        _class = instance.class_type
+        classes = self.class_definitions
+        storage = _class.storage
+        if storage is not None and (classes is None or classes.owns(_class)):
+            slots = storage.new_slots()
+            for index, value in enumerate(instance.slots):
+                slots[index] = value
+            instance.slots = slots
+        self.detached.discard(instance)
+        self.track(instance)
+
+    def instances_of(self, _class: Class) -> list[Instance]:
+        if self.parent is not None:
+            assert self.class_definitions is not None
+            origin = self.class_definitions.origin(_class)
+            for instance in self.parent.instances_of(origin):
+                self.copy(instance)
+        return list(self.instances.get(_class, ()))
+
+    def live(self) -> int:
+        instances = list(self.instances.values())
+        return sum(len(tracked) for tracked in instances) + len(self.detached)
+
+    def copy(self, value: Any) -> Any:
+        # 親の世界の値を子のものにする。参照しているインスタンスもたどって複製し、
+        # 同じインスタンスへの参照は同じ複製を指すようにする
+        if isinstance(value, Instance):
+            if type(value) is not Instance or type(value.slots) is tuple:
+                return value
+            copy = self.copies.get(value)
+            if copy is not None:
+                return copy
+            assert self.class_definitions is not None
+            copy = Instance(self.class_definitions.resolve(value.class_type), [])
+            self.copies[value] = copy
+            copy.slots = [self.copy(v) for v in value.slots]
+            copy.migrate(value.class_type.layout)
+            self.track(copy)
+            return copy
+        if type(value) in (list, tuple, set):
+            return type(value)(self.copy(v) for v in value)
+        if type(value) is dict:
+            return {k: self.copy(v) for k, v in value.items()}
+        return value
+
+    def lookup(self, name: str) -> Optional[Instance]:
+        # 複製せずに、この世界から見えるトップレベルのインスタンスを探す
+        instance = self.globals.get(name)
+        if instance is None and self.parent is not None and name not in self.deleted:
+            return self.parent.lookup(name)
+        return instance
+
+    def global_names(self) -> set[str]:
+        names = set(self.globals)
+        if self.parent is not None:
+            names |= self.parent.global_names() - self.deleted
+        return names
+
+    def all_globals(self) -> dict[str, Instance]:
+        return {name: self.get_instance(name) for name in self.global_names()}
+
     def register_instance(self, name: str, instance: Instance) -> None:
-        self.instances[-1][name] = instance
+        scope = self.scope
+        if len(scope.frames) > 1:
+            scope.bind(name, instance)
+            return
+        with self.lock:
+            log = current_log.get()
+            if log is not None:
+                log.record_key(self.globals, name)
+                if name in self.deleted:
+                    log.call(self.deleted.add, name)
+            self.globals[name] = instance
+            self.deleted.discard(name)
+
+    def bind(self, name: str, instance: Instance) -> None:
+        self.scope.bind(name, instance)
 
     def get_instance(self, instance_name: str) -> Instance:
-        for instances in reversed(self.instances):
-            if instance_name in instances:
-                return instances[instance_name]
-        raise Exception(f"{instance_name} is not defined")
+        stack = self.scope.bindings.get(instance_name)
+        if stack:
+            return stack[-1]
+        instance = self.globals.get(instance_name)
+        if instance is None and self.parent is not None:
+            instance = self.inherit(instance_name)
+        if instance is None:
+            raise Exception(f"{instance_name} is not defined")
+        return instance
+
+    def inherit(self, name: str) -> Optional[Instance]:
+        if name in self.deleted:
+            return None
+        instance = self.parent.lookup(name) if self.parent is not None else None
+        if instance is None:
+            return None
+        with self.lock:
+            copy = self.copy(instance)
+            return self.globals.setdefault(name, copy)
+
+    def delete(self, name: str) -> Instance:
+        # 今のスコープで登録された名前を優先し、無ければトップレベルから消す
+        instance = self.scope.unbind(name)
+        if instance is None:
+            with self.lock:
+                log = current_log.get()
+                if log is not None:
+                    log.record_key(self.globals, name)
+                instance = self.globals.pop(name, None)
+                if self.parent is not None and name not in self.deleted:
+                    inherited = self.parent.lookup(name)
+                    if inherited is not None:
+                        if log is not None:
+                            log.call(self.deleted.discard, name)
+                        self.deleted.add(name)
+                        if instance is None:
+                            # 後で親から複製し直されないよう、複製してから外す
+                            instance = self.copy(inherited)
+        if instance is None:
+            raise Exception(f"{name} is not defined")
+        log = current_log.get()
+        if log is not None:
+            log.record_key(self.reclaimed, "deleted")
+        self.untrack(instance)
+        self.reclaimed["deleted"] += 1
+        return instance
 
     def push(self) -> None:
-        self.instances.append({})
+        self.scope.push()
 
     def pop(self) -> None:
-        self.instances.pop()
+        released = self.scope.pop()
+        if released:
+            self.reclaimed["released"] += released
+
+    def count(self) -> int:
+        bindings = self.scope.bindings.values()
+        return len(self.global_names()) + sum(len(stack) for stack in bindings)
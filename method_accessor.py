@@ -1,14 +1,57 @@
-from typing import Union, Callable, Any
+import importlib
+from typing import Optional, Union, Callable, Any
 
 
 class PublicMethod:
+    __slots__ = ("method",)
+    is_async = False
+
     def __init__(self, method: Callable[..., Any]) -> None:
         self.method = method
 
 
 class PrivateMethod:
+    __slots__ = ("method",)
+    is_async = False
+
     def __init__(self, method: Callable[..., Any]) -> None:
         self.method = method
 
 
+class AsyncPublicMethod(PublicMethod):
+    __slots__ = ()
+    is_async = True
+
+
+class AsyncPrivateMethod(PrivateMethod):
+    __slots__ = ()
+    is_async = True
+
+
 MethodType = Union[PublicMethod, PrivateMethod]
+
+
+def import_reference(path: str) -> Any:
+    module_name, _, qualname = path.partition(":")
+    target: Any = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        target = getattr(target, name)
+    return target
+
+
+class MethodReference:
+    # "module:qualname" で参照するメソッド本体
+    # lambdaと違ってpickleできるので、別プロセスやファイルへ持ち出せる
+    __slots__ = ("path", "target")
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.target: Optional[Callable[..., Any]] = None
+
+    def __call__(self, *args: Any) -> Any:
+        if self.target is None:
+            self.target = import_reference(self.path)
+        return self.target(*args)
+
+    def __reduce__(self) -> tuple[type["MethodReference"], tuple[str]]:
+        return (MethodReference, (self.path,))
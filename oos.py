@@ -1,99 +1,327 @@
-import random
-from attr_accessor import PublicAttr
-from environment import Environment
-from method_accessor import PublicMethod, PrivateMethod
+from collections.abc import Awaitable
+from attr_accessor import AttrGetter
+from environment import Environment, PrimitiveOperation
+from method_accessor import MethodType, PublicMethod
 from instance import Instance
-from exceptions import MethodAccessDenied
-from typing import Any
-from class_definitions import MessageType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    ContextManager,
+    Iterable,
+    MutableMapping,
+    Optional,
+)
+from class_definitions import Class, MessageType, no_constructor
+from send_site import SendSite
+from undo_log import UndoLog, transaction
+
+if TYPE_CHECKING:
+    from columnar import ColumnStore
 
 
 class ObjectOrientedSystem:
     def __init__(self) -> None:
         self.environment = Environment()
+        self.sites: dict[str, SendSite] = {}
 
-        def define(sys: ObjectOrientedSystem) -> None:
-            self.environment.define(
-                sys.send("args", "get-name"),
-                sys.send("args", "get", attr="bases", fallback=[]),
-                [
-                    # intの時はintへ持ち替える
-                    type(p)(p.name, self.convert_value(p.value))
-                    for p in sys.send("args", "get", attr="attrs", fallback=[])
-                ],
-                sys.send("args", "get", attr="constructor", fallback=lambda sys: None),
-                sys.send("args", "get", attr="methods", fallback={}),
-            )
-
-        def new(sys: ObjectOrientedSystem) -> Instance:
-            cls = sys.send("args", "get-cls")
-            name = sys.send("args", "get-name")
-
-            instance = self.environment.new(cls, name)
-
-            with self.environment:
-                self.environment.register_instance("this", instance)
-                instance.class_type.constructor(self)
-                return instance
-
-        self.environment.define(
+        self.environment.class_definitions.register_lazy(
             "environment",
-            [],
-            [],
-            lambda sys: None,
-            {"define": PublicMethod(define), "new": PublicMethod(new)},
+            lambda: self.environment.define(
+                "environment",
+                [],
+                [],
+                no_constructor,
+                dict(ENVIRONMENT_METHODS),
+                inline=True,
+            ),
         )
-
         env = self.environment.new("environment", "env")
         self.environment.register_instance("env", env)
 
+    def transaction(self) -> ContextManager[UndoLog]:
+        # 属性とトップレベルの名前への書き込みを記録し、例外が出たら元に戻す
+        return transaction()
+
+    def fork(self) -> "ObjectOrientedSystem":
+        child = ObjectOrientedSystem.__new__(ObjectOrientedSystem)
+        child.environment = self.environment.fork()
+        child.sites = {}
+        return child
+
+    @property
+    def builtin_classes(self) -> MutableMapping[str, Class]:
+        return self.environment.class_definitions.builtins
+
     def send(
         self, instance_name: str | Instance, method: str, **argv: MessageType
     ) -> Any:
+        # this へのメッセージだけがプライベートなメソッドも含む表を引く
         if isinstance(instance_name, str):
             instance = self.environment.get_instance(instance_name)
+            if instance_name == "this":
+                return self.dispatch(instance, instance.get_method(method), argv)
         else:
             instance = instance_name
+        return self.dispatch(instance, instance.get_public_method(method), argv)
 
-        func = instance.get_method(method)
+    def dispatch(
+        self, instance: Instance, func: MethodType, argv: dict[str, MessageType]
+    ) -> Any:
+        # 組み込みのint/floatへの演算は、引数を箱に入れずに直接計算する
+        if (
+            type(func.method) is PrimitiveOperation
+            and instance.class_type in self.environment.primitive_classes
+            and len(argv) == 1
+            and "value" in argv
+        ):
+            value = self.environment.unbox_primitive(argv["value"])
+            if value is not None:
+                return self.environment.new_tmp_primitive(
+                    func.method.operation(instance.get_attribute("value"), value)
+                )
 
-        if instance_name == "env":
-            _argv = self.instantiate_argv(argv)
-            self.environment.register_instance("args", _argv)
+        if instance.class_type.inline:
+            self.environment.bind("args", self.instantiate_argv(argv))
             return func.method(self)
 
+        # ゲッターは引数もスコープも使わないので、レシーバを直接渡す
+        if isinstance(func.method, AttrGetter):
+            return func.method.get(instance)
+
+        return self.invoke(instance, func, self.instantiate_argv(argv))
+
+    def invoke(self, instance: Instance, func: MethodType, _argv: Instance) -> Any:
+        if func.is_async:
+            return self.ainvoke(instance, func, _argv)
         with self.environment:
-            _argv = self.instantiate_argv(argv)
-            self.environment.register_instance("args", _argv)
-            self.environment.register_instance("this", instance)
-            if instance_name == "this":
-                return func.method(self)
+            self.environment.bind("args", _argv)
+            self.environment.bind("this", instance)
+            return func.method(self)
 
-            if isinstance(func, PrivateMethod):
-                raise MethodAccessDenied(f"{method} is PrivateMethod")
-            elif isinstance(func, PublicMethod):
-                return func.method(self)
+    async def ainvoke(
+        self, instance: Instance, func: MethodType, _argv: Instance
+    ) -> Any:
+        with self.environment.instance_management.forked_scope():
+            with self.environment:
+                self.environment.bind("args", _argv)
+                self.environment.bind("this", instance)
+                return await func.method(self)
+
+    async def asend(
+        self, instance_name: str | Instance, method: str, **argv: MessageType
+    ) -> Any:
+        result = self.send(instance_name, method, **argv)
+        if isinstance(result, Awaitable):
+            return await result
+        return result
+
+    def site(self, method: str) -> SendSite:
+        site = self.sites.get(method)
+        if site is None:
+            site = self.sites[method] = SendSite(self, method)
+        return site
+
+    def send_many(
+        self, receivers: Iterable[str | Instance], method: str, **argv: MessageType
+    ) -> list[Any]:
+        # 全てのレシーバで同じ引数インスタンスを共有する
+        _argv = self.instantiate_argv(argv)
+        return self.dispatch_many(((receiver, _argv) for receiver in receivers), method)
+
+    def send_each(
+        self,
+        receivers: Iterable[str | Instance],
+        method: str,
+        argvs: Iterable[dict[str, MessageType]],
+    ) -> list[Any]:
+        return self.dispatch_many(
+            (
+                (receiver, self.instantiate_argv(argv))
+                for receiver, argv in zip(receivers, argvs, strict=True)
+            ),
+            method,
+        )
+
+    def dispatch_many(
+        self, calls: Iterable[tuple[str | Instance, Instance]], method: str
+    ) -> list[Any]:
+        # send と同じく、this へのメッセージはプライベートなメソッドも引き、
+        # inline なクラスは呼び出し元のスコープのまま動かす
+        resolved: dict[tuple[Class, bool], MethodType] = {}
+        results = []
+        for receiver, _argv in calls:
+            internal = receiver == "this"
+            if isinstance(receiver, str):
+                instance = self.environment.get_instance(receiver)
+            else:
+                instance = receiver
+
+            key = (instance.class_type, internal)
+            func = resolved.get(key)
+            if func is None:
+                if internal:
+                    func = instance.get_method(method)
+                else:
+                    func = instance.get_public_method(method)
+                resolved[key] = func
+
+            if instance.class_type.inline:
+                self.environment.bind("args", _argv)
+                results.append(func.method(self))
+                continue
+
+            if isinstance(func.method, AttrGetter):
+                results.append(func.method.get(instance))
+                continue
+
+            results.append(self.invoke(instance, func, _argv))
+        return results
 
     def convert_value(self, value: Any) -> Any:
         if self.environment.is_primitive(value):
-            return self.environment.new_tmp_primitive(value)
+            return self.environment.new_tmp_primitive(value, literal=True)
         return value
 
     def instantiate_argv(self, argv: dict[str, MessageType]) -> Instance:
-        _argv = {k: self.convert_value(v) for k, v in argv.items()}
-
-        name = "args%f" % random.random()
-        self.environment.define(
-            name,
-            [],
-            [PublicAttr(k, v) for k, v in _argv.items()],
-            lambda sys: None,
-            {
-                "get": PublicMethod(
-                    lambda sys: sys.send("this", "get-" + sys.send("args", "get-attr"))
-                    if sys.send("args", "get-attr") in argv
-                    else sys.send("args", "get-fallback")
-                ),
-            },
+        return self.environment.new_arguments(
+            {k: self.convert_value(v) for k, v in argv.items()}
         )
-        return self.environment.new(name, "args")
+
+
+# 環境のメソッドは全てのシステムで共有し、重いモジュールは使う時に読み込む
+def define(sys: "ObjectOrientedSystem") -> None:
+    methods = sys.send("args", "get", attr="methods", fallback={})
+    if sys.send("args", "get", attr="compile", fallback=False):
+        from compiler import compile_method
+
+        methods = {name: compile_method(f) for name, f in methods.items()}
+    sys.environment.define(
+        sys.send("args", "get-name"),
+        sys.send("args", "get", attr="bases", fallback=[]),
+        [
+            # intの時はintへ持ち替える
+            type(p)(p.name, sys.convert_value(p.value))
+            for p in sys.send("args", "get", attr="attrs", fallback=[])
+        ],
+        sys.send("args", "get", attr="constructor", fallback=no_constructor),
+        methods,
+    )
+
+
+def new(sys: "ObjectOrientedSystem") -> Instance:
+    cls = sys.send("args", "get-cls")
+    name = sys.send("args", "get-name")
+
+    instance = sys.environment.new(cls, name)
+
+    with sys.environment:
+        sys.environment.bind("this", instance)
+        instance.class_type.constructor(sys)
+        return instance
+
+
+def new_many(sys: "ObjectOrientedSystem") -> list[Instance]:
+    cls = sys.send("args", "get-cls")
+    names = list(sys.send("args", "get-names"))
+    argvs = list(sys.send("args", "get", attr="argv", fallback=[{}] * len(names)))
+    if len(argvs) != len(names):
+        raise ValueError("names and argv must have the same length")
+
+    # クラスとコンストラクタは一度だけ解決して使い回す
+    _class = sys.environment.class_definitions.get_class(cls)
+    constructor = _class.constructor
+
+    instances = []
+    for name, argv in zip(names, argvs):
+        instance = sys.environment.instance_management.make_instance(_class, name)
+        with sys.environment:
+            _argv = sys.instantiate_argv({"cls": cls, "name": name, **argv})
+            sys.environment.bind("args", _argv)
+            sys.environment.bind("this", instance)
+            constructor(sys)
+        instances.append(instance)
+    return instances
+
+
+def columnar(sys: "ObjectOrientedSystem") -> "ColumnStore":
+    from columnar import ColumnStore
+
+    _class = sys.environment.class_definitions.own(sys.send("args", "get-cls"))
+    store = ColumnStore(
+        _class,
+        sys.environment,
+        sys.send("args", "get-columns"),
+        sys.send("args", "get", attr="path", fallback=None),
+        sys.send(sys.send("args", "get", attr="capacity", fallback=1024), "get-value"),
+    )
+    for instance in sys.environment.instance_management.instances_of(_class):
+        if type(instance.slots) is list:
+            instance.slots = store.adopt(instance.slots)
+    _class.storage = store
+    return store
+
+
+def map_attr(sys: "ObjectOrientedSystem") -> None:
+    import vectorized
+
+    vectorized.map_attr(
+        sys.environment,
+        sys.environment.class_definitions.get_class(sys.send("args", "get-cls")),
+        sys.send("args", "get-attr"),
+        sys.send("args", "get-op"),
+        sys.send(sys.send("args", "get-value"), "get-value"),
+    )
+
+
+def reduce_attr(sys: "ObjectOrientedSystem") -> Optional[Instance]:
+    import vectorized
+
+    result = vectorized.reduce_attr(
+        sys.environment,
+        sys.environment.class_definitions.get_class(sys.send("args", "get-cls")),
+        sys.send("args", "get-attr"),
+        sys.send("args", "get-op"),
+    )
+    if result is None:
+        return None
+    return sys.environment.new_tmp_primitive(result)
+
+
+def index(sys: "ObjectOrientedSystem") -> None:
+    import query
+
+    query.create_index(
+        sys.environment,
+        sys.send("args", "get-cls"),
+        sys.send("args", "get-attr"),
+        sys.send("args", "get", attr="kind", fallback="hash"),
+    )
+
+
+def query(sys: "ObjectOrientedSystem") -> list[Instance]:
+    import query
+
+    return query.query(
+        sys.environment,
+        sys.send("args", "get-cls"),
+        sys.send("args", "get", attr="where", fallback={}),
+    )
+
+
+def delete(sys: "ObjectOrientedSystem") -> None:
+    sys.environment.delete(sys.send("args", "get-name"))
+
+
+ENVIRONMENT_METHODS: dict[str, MethodType] = {
+    "define": PublicMethod(define),
+    "new": PublicMethod(new),
+    "new-many": PublicMethod(new_many),
+    "columnar": PublicMethod(columnar),
+    "map-attr": PublicMethod(map_attr),
+    "reduce-attr": PublicMethod(reduce_attr),
+    "index": PublicMethod(index),
+    "query": PublicMethod(query),
+    "delete": PublicMethod(delete),
+    "sweep": PublicMethod(lambda sys: sys.environment.sweep()),
+    "reclaimed": PublicMethod(lambda sys: sys.environment.reclaimed()),
+}
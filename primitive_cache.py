@@ -0,0 +1,89 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable, Optional
+from class_definitions import Class
+from instance import Instance
+
+COMMON_FLOATS = (0.0, 1.0, -1.0, 0.5, 2.0, 10.0, 100.0)
+
+
+def cache_key(value: Any) -> Any:
+    # 1 と 1.0、0.0 と -0.0 は等しいが別の箱にする
+    if type(value) is float:
+        return (float, value, math.copysign(1.0, value))
+    return (type(value), value)
+
+
+def pinned_keys(small_ints: Iterable[int], floats: Iterable[float]) -> frozenset[Any]:
+    return frozenset(cache_key(v) for v in (*small_ints, *floats))
+
+
+# システムを作るたびに計算しないよう、既定の値はモジュールで一度だけ作る
+# 残高のように増え続ける値は同じ値が二度来ないので、固定する整数は狭くしておく
+SMALL_INTS = range(-5, 17)
+DEFAULT_PINNED_KEYS = pinned_keys(SMALL_INTS, COMMON_FLOATS)
+
+
+class PrimitiveCache:
+    # 共有される数値の箱はスロットをタプルにして書き換えられないようにする
+    # 小さい整数とよく使う浮動小数点数、リテラルとして渡された値は固定で持ち、
+    # それ以外はLRUで追い出す
+    def __init__(
+        self,
+        small_ints: Optional[Iterable[int]] = None,
+        floats: Optional[Iterable[float]] = None,
+        size: int = 8,
+        literals: int = 256,
+    ) -> None:
+        self.pinned_keys = DEFAULT_PINNED_KEYS
+        if small_ints is not None or floats is not None:
+            self.pinned_keys = pinned_keys(
+                SMALL_INTS if small_ints is None else small_ints,
+                COMMON_FLOATS if floats is None else floats,
+            )
+        self.size = size
+        self.literals = literals
+        self.pinned: dict[Any, Instance] = {}
+        self.recent: OrderedDict[Any, Instance] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def box(self, _class: Class, value: Any, literal: bool = False) -> Instance:
+        key = cache_key(value)
+        instance = self.pinned.get(key)
+        if instance is None:
+            instance = self.recent.get(key)
+            if instance is not None:
+                try:
+                    self.recent.move_to_end(key)
+                except KeyError:
+                    pass
+        if instance is not None and instance.class_type is _class:
+            self.hits += 1
+            return instance
+
+        self.misses += 1
+        slots = list(_class.default_slots)
+        slots[_class.layout["value"]] = value
+        instance = Instance(_class, tuple(slots))
+        pin = key in self.pinned_keys
+        with self.lock:
+            if pin or (literal and len(self.pinned) < self.literals):
+                self.pinned[key] = instance
+            elif self.size > 0:
+                self.recent[key] = instance
+                self.recent.move_to_end(key)
+                while len(self.recent) > self.size:
+                    self.recent.popitem(last=False)
+        return instance
+
+    def clear(self) -> None:
+        with self.lock:
+            self.pinned.clear()
+            self.recent.clear()
+
+
+def is_shared(instance: Instance) -> bool:
+    return type(instance.slots) is tuple
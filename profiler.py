@@ -0,0 +1,182 @@
+import json
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Optional, TypedDict
+from class_definitions import MessageType
+from instance import Instance
+from oos import ObjectOrientedSystem
+
+# report の1行。"class" はキーワードなので関数形式で定義する
+MethodRow = TypedDict(
+    "MethodRow",
+    {
+        "class": str,
+        "method": str,
+        "calls": int,
+        "total_time": float,
+        "self_time": float,
+        "allocations": int,
+    },
+)
+
+
+class MethodStats:
+    __slots__ = ("calls", "total_time", "self_time", "allocations")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.total_time = 0.0
+        self.self_time = 0.0
+        self.allocations = 0
+
+
+class DispatchProfiler:
+    # 有効な間だけsendとインスタンス生成をインスタンス属性で差し替える
+    # 無効時はObjectOrientedSystem側に一切コストがかからない
+    def __init__(self, system: ObjectOrientedSystem) -> None:
+        self.system = system
+        self.stats: dict[tuple[str, str], MethodStats] = {}
+        self.depths: Counter[int] = Counter()
+        self.allocations = 0
+        self.enabled = False
+        self.local = threading.local()
+
+    def __enter__(self) -> "DispatchProfiler":
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.disable()
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+        self.enabled = True
+        environment = self.system.environment
+        instance_management = environment.instance_management
+        setattr(self.system, "send", self.wrap_send(self.system.send))
+        for owner, name in (
+            (environment, "new_tmp_primitive"),
+            (environment, "new_arguments"),
+            (instance_management, "make_instance"),
+        ):
+            setattr(owner, name, self.wrap_allocation(getattr(owner, name)))
+
+    def disable(self) -> None:
+        if not self.enabled:
+            return
+        self.enabled = False
+        environment = self.system.environment
+        del self.system.send
+        del environment.new_tmp_primitive
+        del environment.new_arguments
+        del environment.instance_management.make_instance
+
+    def reset(self) -> None:
+        self.stats = {}
+        self.depths = Counter()
+        self.allocations = 0
+
+    def wrap_allocation(
+        self, allocate: Callable[..., Instance]
+    ) -> Callable[..., Instance]:
+        def wrapper(*args: Any, **kwargs: Any) -> Instance:
+            self.allocations += 1
+            return allocate(*args, **kwargs)
+
+        return wrapper
+
+    def wrap_send(self, send: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(
+            instance_name: str | Instance, method: str, **argv: MessageType
+        ) -> Any:
+            try:
+                if isinstance(instance_name, str):
+                    instance = self.system.environment.get_instance(instance_name)
+                else:
+                    instance = instance_name
+                class_name = instance.class_type.name
+            except Exception:
+                return send(instance_name, method, **argv)
+
+            children = self.children
+            children.append(0.0)
+            self.depths[len(children)] += 1
+            allocations = self.allocations
+            start = time.perf_counter()
+            try:
+                return send(instance_name, method, **argv)
+            finally:
+                elapsed = time.perf_counter() - start
+                child_time = children.pop()
+                if children:
+                    children[-1] += elapsed
+                key = (class_name, method)
+                stats = self.stats.get(key)
+                if stats is None:
+                    stats = self.stats[key] = MethodStats()
+                stats.calls += 1
+                stats.total_time += elapsed
+                stats.self_time += elapsed - child_time
+                stats.allocations += self.allocations - allocations
+
+        return wrapper
+
+    @property
+    def children(self) -> list[float]:
+        # 呼び出しの入れ子はスレッドごとに追跡する
+        children = getattr(self.local, "children", None)
+        if children is None:
+            children = self.local.children = []
+        return children
+
+    def report(self) -> list[MethodRow]:
+        rows: list[MethodRow] = [
+            {
+                "class": class_name,
+                "method": method,
+                "calls": stats.calls,
+                "total_time": stats.total_time,
+                "self_time": stats.self_time,
+                "allocations": stats.allocations,
+            }
+            for (class_name, method), stats in self.stats.items()
+        ]
+        rows.sort(key=lambda row: row["total_time"], reverse=True)
+        return rows
+
+    def depth_histogram(self) -> dict[int, int]:
+        return dict(sorted(self.depths.items()))
+
+    def counts(self) -> dict[str, int]:
+        environment = self.system.environment
+        return {
+            "classes": len(environment.class_definitions.classes),
+            "instances": environment.instance_management.count(),
+            "allocations": self.allocations,
+        }
+
+    def export(self, path: Optional[str] = None) -> dict[str, Any]:
+        data = {
+            "methods": self.report(),
+            "depths": self.depth_histogram(),
+            "counts": self.counts(),
+        }
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(data, f, indent=2)
+        return data
+
+    def format(self, limit: int = 20) -> str:
+        lines = [
+            f"{'class':<20} {'method':<20} {'calls':>8} {'total(s)':>10} "
+            f"{'self(s)':>10} {'allocs':>8}"
+        ]
+        for row in self.report()[:limit]:
+            lines.append(
+                f"{row['class']:<20} {row['method']:<20} {row['calls']:>8} "
+                f"{row['total_time']:>10.6f} {row['self_time']:>10.6f} "
+                f"{row['allocations']:>8}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,287 @@
+import operator
+import threading
+from abc import ABC, abstractmethod
+import weakref
+from bisect import bisect_left, bisect_right
+from typing import Any, Callable, Iterable, Optional, Union
+from environment import Environment
+from instance import Instance
+from undo_log import MISSING
+
+OPERATORS: dict[str, Callable[[Any, Any], bool]] = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, values: value in values,
+}
+
+Predicate = Union[Any, tuple[str, Any], Callable[[Any], bool]]
+
+
+class AttrIndex(ABC):
+    # クラスの属性の値からインスタンスを引く索引
+    # 生成されたセッターが書き込むたびに refresh で更新される
+    def __init__(self, attr: str, environment: Environment) -> None:
+        self.attr = attr
+        self.environment = environment
+        self.lock = threading.Lock()
+
+    def key_of(self, instance: Instance) -> Any:
+        index = instance.class_type.layout.get(self.attr)
+        if index is None:
+            return MISSING
+        value = instance.slots[index]
+        raw = self.environment.unbox_primitive(value)
+        return value if raw is None else raw
+
+    def refresh(self, instance: Instance) -> None:
+        # 他の世界(forkした子)のインスタンスや消したインスタンスは索引から外す
+        tracked = self.environment.instance_management.instances
+        key = MISSING
+        if instance in tracked.get(instance.class_type, ()):
+            key = self.key_of(instance)
+        with self.lock:
+            self.remove(instance)
+            if key is not MISSING:
+                self.insert(instance, key)
+
+    @abstractmethod
+    def remove(self, instance: Instance) -> None: ...
+
+    @abstractmethod
+    def insert(self, instance: Instance, key: Any) -> None: ...
+
+
+class HashIndex(AttrIndex):
+    def __init__(self, attr: str, environment: Environment) -> None:
+        super().__init__(attr, environment)
+        self.buckets: dict[Any, weakref.WeakSet[Instance]] = {}
+        self.keys: weakref.WeakKeyDictionary[Instance, Any] = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def remove(self, instance: Instance) -> None:
+        key = self.keys.pop(instance, MISSING)
+        if key is MISSING:
+            return
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.discard(instance)
+            if not bucket:
+                del self.buckets[key]
+
+    def insert(self, instance: Instance, key: Any) -> None:
+        try:
+            bucket = self.buckets.setdefault(key, weakref.WeakSet())
+        except TypeError:
+            return
+        bucket.add(instance)
+        self.keys[instance] = key
+
+    def equal(self, value: Any) -> list[Instance]:
+        with self.lock:
+            try:
+                return list(self.buckets.get(value, ()))
+            except TypeError:
+                return []
+
+
+class SortedIndex(AttrIndex):
+    # (値, id) を整列して持ち、範囲を二分探索で取り出す
+    # 比較できない値と None は索引に入れず、比較できない値のものは skipped に覚える
+    def __init__(self, attr: str, environment: Environment) -> None:
+        super().__init__(attr, environment)
+        self.entries: list[tuple[Any, int]] = []
+        self.refs: dict[int, weakref.ref[Instance]] = {}
+        self.keys: dict[int, Any] = {}
+        self.skipped: weakref.WeakSet[Instance] = weakref.WeakSet()
+
+    def remove(self, instance: Instance) -> None:
+        self.skipped.discard(instance)
+        self.discard(id(instance))
+
+    def discard(self, ident: int) -> None:
+        key = self.keys.pop(ident, MISSING)
+        self.refs.pop(ident, None)
+        if key is MISSING:
+            return
+        entries = self.entries
+        i = bisect_left(entries, (key, ident))
+        if i < len(entries) and entries[i] == (key, ident):
+            del entries[i]
+
+    def insert(self, instance: Instance, key: Any) -> None:
+        if key is None:
+            return
+        ident = id(instance)
+        entries = self.entries
+        try:
+            i = bisect_left(entries, (key, ident))
+        except TypeError:
+            self.skipped.add(instance)
+            return
+        entries.insert(i, (key, ident))
+        self.keys[ident] = key
+        self.refs[ident] = weakref.ref(instance, self.collected(ident))
+
+    def collected(self, ident: int) -> Callable[[Any], None]:
+        def callback(_: Any) -> None:
+            with self.lock:
+                self.discard(ident)
+
+        return callback
+
+    def range(
+        self,
+        low: Any = None,
+        high: Any = None,
+        low_inclusive: bool = True,
+        high_inclusive: bool = True,
+    ) -> Optional[list[Instance]]:
+        # 索引に入っていないインスタンスがある時や比較できない時は None を返す
+        entries = self.entries
+        first = lambda entry: entry[0]
+        with self.lock:
+            if self.skipped:
+                return None
+            try:
+                start, stop = 0, len(entries)
+                if low is not None:
+                    find = bisect_left if low_inclusive else bisect_right
+                    start = find(entries, low, key=first)
+                if high is not None:
+                    find = bisect_right if high_inclusive else bisect_left
+                    stop = find(entries, high, key=first)
+            except TypeError:
+                return None
+            refs = [self.refs.get(ident) for _, ident in entries[start:stop]]
+        return [instance for ref in refs if ref and (instance := ref()) is not None]
+
+
+INDEX_TYPES: dict[str, type[AttrIndex]] = {"hash": HashIndex, "sorted": SortedIndex}
+
+
+def create_index(
+    environment: Environment, cls: str, attr: str, kind: str = "hash"
+) -> AttrIndex:
+    # 索引はクラスに持たせ、サブクラスも同じ索引を引き継ぐ
+    # forkした子では親のクラスを複製してから索引を付ける
+    _class = environment.class_definitions.own(cls)
+    if attr not in _class.layout:
+        raise KeyError(attr)
+    index = INDEX_TYPES[kind](attr, environment)
+    _class.indexes.setdefault(attr, []).append(index)
+    _class.invalidate()
+    for member in _class.family():
+        for instance in environment.instance_management.instances_of(member):
+            index.refresh(instance)
+    return index
+
+
+def matcher(predicate: Predicate, environment: Environment) -> Callable[[Any], bool]:
+    if isinstance(predicate, tuple):
+        op, expected = predicate
+        compare = OPERATORS[op]
+        expected = unbox(environment, expected)
+        return lambda value: safe(compare, value, expected)
+    if callable(predicate) and not isinstance(predicate, Instance):
+        return predicate
+    expected = unbox(environment, predicate)
+    return lambda value: safe(operator.eq, value, expected)
+
+
+def unbox(environment: Environment, value: Any) -> Any:
+    raw = environment.unbox_primitive(value)
+    return value if raw is None else raw
+
+
+def safe(compare: Callable[[Any, Any], bool], value: Any, expected: Any) -> bool:
+    try:
+        return bool(compare(value, expected))
+    except TypeError:
+        return False
+
+
+def candidates(
+    index: AttrIndex, predicate: Predicate, environment: Environment
+) -> Optional[list[Instance]]:
+    # 索引で絞り込めない条件は None を返し、走査に任せる
+    if callable(predicate) and not isinstance(predicate, (tuple, Instance)):
+        return None
+    op, expected = predicate if isinstance(predicate, tuple) else ("==", predicate)
+    expected = unbox(environment, expected)
+    # None は並べ替えの索引に入らず、範囲の指定では「制限なし」を意味するので走査する
+    if expected is None and isinstance(index, SortedIndex):
+        return None
+    if isinstance(index, HashIndex):
+        if op == "==":
+            return index.equal(expected)
+        if op == "in":
+            values = [unbox(environment, value) for value in expected]
+            return [instance for value in values for instance in index.equal(value)]
+        return None
+    if isinstance(index, SortedIndex):
+        if op == "==":
+            return index.range(expected, expected)
+        if op in ("<", "<="):
+            return index.range(high=expected, high_inclusive=op == "<=")
+        if op in (">", ">="):
+            return index.range(low=expected, low_inclusive=op == ">=")
+    return None
+
+
+def query(
+    environment: Environment, cls: str, where: Optional[dict[str, Predicate]] = None
+) -> list[Instance]:
+    # クラスとそのサブクラスのインスタンスのうち、全ての条件を満たすものを返す
+    # 使える索引があれば一番小さい候補から絞り込み、無ければ全て走査する
+    classes = environment.class_definitions
+    instance_management = environment.instance_management
+    _class = classes.get_class(cls)
+    where = where or {}
+    family = _class.family()
+    members = set(family)
+    checks = [(attr, matcher(p, environment)) for attr, p in where.items()]
+
+    found: Optional[list[Instance]] = None
+    if classes.owns(_class):
+        for attr, predicate in where.items():
+            for index in _class.index_table.get(attr, ()):
+                result = candidates(index, predicate, environment)
+                if result is not None and (found is None or len(result) < len(found)):
+                    found = result
+
+    pool: Iterable[Instance]
+    if found is None:
+        pool = [
+            instance
+            for member in family
+            for instance in instance_management.instances_of(member)
+        ]
+    else:
+        tracked = instance_management.instances
+        pool = [
+            i
+            for i in dict.fromkeys(found)
+            if i.class_type in members and i in tracked.get(i.class_type, ())
+        ]
+    return [
+        instance
+        for instance in pool
+        if all(matches(instance, attr, check, environment) for attr, check in checks)
+    ]
+
+
+def matches(
+    instance: Instance,
+    attr: str,
+    check: Callable[[Any], bool],
+    environment: Environment,
+) -> bool:
+    index = instance.class_type.layout.get(attr)
+    if index is None:
+        return False
+    return check(unbox(environment, instance.slots[index]))
@@ -0,0 +1,49 @@
+from typing import TYPE_CHECKING, Any, Optional
+from class_definitions import Class, MessageType
+from instance import Instance
+from method_accessor import MethodType
+
+if TYPE_CHECKING:
+    from oos import ObjectOrientedSystem as System
+
+
+class SendSite:
+    # 受信側のクラスごとに解決済みのメソッドを覚えておくインラインキャッシュ
+    # クラスか基底クラスが変更されるとクラスのバージョンが上がり、キャッシュは無効になる
+    def __init__(self, system: "System", method: str, limit: int = 4) -> None:
+        self.system = system
+        self.method = method
+        self.limit = limit
+        self.entries: list[tuple[Class, int, Optional[MethodType], MethodType]] = []
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, instance: Instance, internal: bool = False) -> MethodType:
+        # 外から呼べるメソッドと、this から呼べるメソッドを組で覚えておく
+        class_type = instance.class_type
+        for cached_class, version, public, func in self.entries:
+            if cached_class is class_type and version == class_type.version:
+                self.hits += 1
+                if internal or public is not None:
+                    return func
+                return instance.get_public_method(self.method)
+
+        self.misses += 1
+        func = instance.get_method(self.method)
+        public = class_type.public_table.get(self.method)
+        entries = [entry for entry in self.entries if entry[0] is not class_type]
+        if len(entries) >= self.limit:
+            del entries[: len(entries) - self.limit + 1]
+        entries.append((class_type, class_type.version, public, func))
+        self.entries = entries
+        if internal or public is not None:
+            return func
+        return instance.get_public_method(self.method)
+
+    def send(self, instance_name: str | Instance, **argv: MessageType) -> Any:
+        if isinstance(instance_name, str):
+            instance = self.system.environment.get_instance(instance_name)
+            return self.system.dispatch(
+                instance, self.lookup(instance, instance_name == "this"), argv
+            )
+        return self.system.dispatch(instance_name, self.lookup(instance_name), argv)
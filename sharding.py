@@ -0,0 +1,163 @@
+import multiprocessing
+import zlib
+from multiprocessing.connection import Connection
+from typing import Any, Iterable, Optional
+from class_definitions import MessageType
+from instance import Instance
+from method_accessor import import_reference
+from oos import ObjectOrientedSystem
+
+Message = tuple[str, str, dict[str, MessageType]]
+
+
+class RemoteInstance:
+    # シャードから返されたインスタンスの写し
+    def __init__(self, class_name: str, attributes: dict[str, Any]) -> None:
+        self.class_name = class_name
+        self.attributes = attributes
+
+    def __repr__(self) -> str:
+        return f"RemoteInstance({self.class_name!r}, {self.attributes!r})"
+
+
+def export_value(system: ObjectOrientedSystem, value: Any) -> Any:
+    if isinstance(value, Instance):
+        if value.class_type in system.environment.primitive_classes:
+            return value.get_attribute("value")
+        return RemoteInstance(
+            value.class_type.name,
+            {k: export_value(system, v) for k, v in value.attributes.items()},
+        )
+    if isinstance(value, (list, tuple)):
+        return type(value)(export_value(system, v) for v in value)
+    return value
+
+
+def serve(connection: Connection, setup: Optional[str]) -> None:
+    system = ObjectOrientedSystem()
+    if setup is not None:
+        import_reference(setup)(system)
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        try:
+            results = [
+                export_value(system, system.send(name, method, **argv))
+                for name, method, argv in request
+            ]
+        except Exception as e:
+            connection.send(("error", e))
+        else:
+            connection.send(("ok", results))
+    connection.close()
+
+
+class ShardedSystem:
+    # インスタンスを名前で複数のプロセスへ振り分ける
+    # クラス定義は全シャードへ配るので、メソッドはMethodReferenceなどpickleできるもので渡す
+    # メソッドの中から他のシャードのインスタンスへは送信できない
+    def __init__(self, shards: int, setup: Optional[str] = None) -> None:
+        self.connections: list[Connection] = []
+        self.processes: list[multiprocessing.process.BaseProcess] = []
+        for _ in range(shards):
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=serve, args=(child, setup), daemon=True
+            )
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+
+    def __enter__(self) -> "ShardedSystem":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for connection in self.connections:
+            connection.send(None)
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
+
+    def shard_of(self, name: str) -> int:
+        return zlib.crc32(name.encode()) % len(self.connections)
+
+    def define(self, **argv: MessageType) -> None:
+        self.broadcast([("env", "define", argv)])
+
+    def new(self, cls: str, name: str, **argv: MessageType) -> Any:
+        return self.send("env", "new", cls=cls, name=name, **argv)
+
+    def new_many(
+        self,
+        cls: str,
+        names: list[str],
+        argv: Optional[list[dict[str, MessageType]]] = None,
+    ) -> None:
+        argvs = argv if argv is not None else [{}] * len(names)
+        if len(argvs) != len(names):
+            raise ValueError("names and argv must have the same length")
+        groups: dict[int, tuple[list[str], list[dict[str, MessageType]]]] = {}
+        for name, _argv in zip(names, argvs):
+            group = groups.setdefault(self.shard_of(name), ([], []))
+            group[0].append(name)
+            group[1].append(_argv)
+        for shard, (shard_names, shard_argvs) in groups.items():
+            message_argv = {"cls": cls, "names": shard_names, "argv": shard_argvs}
+            self.connections[shard].send([("env", "new-many", message_argv)])
+        self.receive(list(groups))
+
+    def send(self, instance_name: str, method: str, **argv: MessageType) -> Any:
+        return self.send_batch([(instance_name, method, argv)])[0]
+
+    def send_batch(self, messages: Iterable[Message]) -> list[Any]:
+        # シャードごとにまとめて一往復で送り、元の順番で結果を返す
+        batches: dict[int, list[Message]] = {}
+        positions: dict[int, list[int]] = {}
+        count = 0
+        for position, message in enumerate(messages):
+            shard = self.route(message)
+            batches.setdefault(shard, []).append(message)
+            positions.setdefault(shard, []).append(position)
+            count += 1
+
+        for shard, batch in batches.items():
+            self.connections[shard].send(batch)
+        results: list[Any] = [None] * count
+        for shard, payload in zip(batches, self.receive(list(batches))):
+            for position, result in zip(positions[shard], payload):
+                results[position] = result
+        return results
+
+    def broadcast(self, messages: list[Message]) -> list[list[Any]]:
+        for connection in self.connections:
+            connection.send(messages)
+        return self.receive(list(range(len(self.connections))))
+
+    def receive(self, shards: list[int]) -> list[list[Any]]:
+        # 全シャードから受け取ってから例外を投げ、パイプの送受信を揃えておく
+        payloads = []
+        error: Optional[Exception] = None
+        for shard in shards:
+            status, payload = self.connections[shard].recv()
+            if status == "error":
+                error = error or payload
+                payload = []
+            payloads.append(payload)
+        if error is not None:
+            raise error
+        return payloads
+
+    def route(self, message: Message) -> int:
+        name, method, argv = message
+        if name == "env":
+            if method != "new" or "name" not in argv:
+                raise ValueError(f"env {method} cannot be routed to a shard")
+            return self.shard_of(argv["name"])
+        return self.shard_of(name)
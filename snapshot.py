@@ -0,0 +1,207 @@
+import pickle
+import sys
+import zlib
+from typing import Any, Callable
+from attr_accessor import PrivateAttr, PublicAttr, ReadonlyAttr
+from class_definitions import Class
+from compiler import CompiledMethod, compile_method
+from exceptions import SnapshotError
+from instance import Instance
+from method_accessor import (
+    AsyncPrivateMethod,
+    AsyncPublicMethod,
+    MethodReference,
+    MethodType,
+    PrivateMethod,
+    PublicMethod,
+    import_reference,
+)
+from oos import ObjectOrientedSystem
+from primitive_cache import is_shared
+
+MAGIC = b"OOS1"
+
+ATTR_TYPES = {t.__name__: t for t in (PublicAttr, PrivateAttr, ReadonlyAttr)}
+METHOD_TYPES = {
+    t.__name__: t
+    for t in (PublicMethod, PrivateMethod, AsyncPublicMethod, AsyncPrivateMethod)
+}
+
+
+def reference(func: Callable[..., Any]) -> str:
+    # lambdaはモジュールの変数に代入されていれば、その名前で参照する
+    if isinstance(func, MethodReference):
+        return func.path
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", "")
+    if module is not None and "<" not in qualname:
+        return f"{module}:{qualname}"
+    if module in sys.modules:
+        for name, value in vars(sys.modules[module]).items():
+            if value is func:
+                return f"{module}:{name}"
+    raise SnapshotError(f"{func!r} cannot be referenced by an importable name")
+
+
+class Encoder:
+    def __init__(self, system: ObjectOrientedSystem) -> None:
+        self.system = system
+        self.ids: dict[int, int] = {}
+        self.instances: list[Any] = []
+        self.refs: dict[int, Any] = {}
+        self.classes: list[Any] = []
+
+    def method(self, func: MethodType) -> tuple[str, str, bool]:
+        body = func.method
+        if isinstance(body, CompiledMethod):
+            return (type(func).__name__, reference(body.body), True)
+        return (type(func).__name__, reference(body), False)
+
+    def class_ref(self, _class: Class) -> Any:
+        # 今の定義は名前で参照し、再定義される前の古い定義は ("stale", 番号) で参照する
+        # 基底クラスを先に定義できるように、基底クラスから順に並べる
+        key = id(_class)
+        if key in self.refs:
+            return self.refs[key]
+        classes = self.system.environment.class_definitions.classes
+        if self.system.builtin_classes.get(_class.name) is _class:
+            self.refs[key] = _class.name
+            return _class.name
+        bases = [
+            self.class_ref(base) for base in _class.bases if isinstance(base, Class)
+        ]
+        if classes.get(_class.name) is _class:
+            ref: Any = _class.name
+        else:
+            ref = ("stale", len(self.classes))
+        self.refs[key] = ref
+        self.classes.append(
+            (
+                ref,
+                _class.name,
+                bases,
+                [(type(a).__name__, a.name, self.value(a.value)) for a in _class.attrs],
+                reference(_class.constructor),
+                {name: self.method(func) for name, func in _class.methods.items()},
+            )
+        )
+        return ref
+
+    def instance(self, instance: Instance) -> int:
+        key = id(instance)
+        if key not in self.ids:
+            self.ids[key] = len(self.instances)
+            self.instances.append(None)
+            self.instances[self.ids[key]] = (
+                self.class_ref(instance.class_type),
+                {k: self.value(v) for k, v in instance.attributes.items()},
+            )
+        return self.ids[key]
+
+    def value(self, value: Any) -> Any:
+        if isinstance(value, Instance):
+            # キャッシュで共有される数値の箱は、復元時もキャッシュから取り直す
+            if is_shared(value):
+                return ("primitive", value.get_attribute("value"))
+            return ("instance", self.instance(value))
+        if isinstance(value, list):
+            return ("list", [self.value(v) for v in value])
+        if isinstance(value, tuple):
+            return ("tuple", [self.value(v) for v in value])
+        if isinstance(value, dict):
+            return ("dict", [(k, self.value(v)) for k, v in value.items()])
+        return ("raw", value)
+
+
+def dumps(system: ObjectOrientedSystem) -> bytes:
+    encoder = Encoder(system)
+    for _class in list(system.environment.class_definitions.classes.values()):
+        encoder.class_ref(_class)
+    environment_class = system.builtin_classes["environment"]
+    instances = system.environment.instance_management.all_globals()
+    # インスタンスから古い定義のクラスが見つかるので、クラスは最後に書き出す
+    globals_ = {
+        name: encoder.instance(instance)
+        for name, instance in instances.items()
+        if instance.class_type is not environment_class
+    }
+    payload = {
+        "classes": encoder.classes,
+        "globals": globals_,
+        "instances": encoder.instances,
+    }
+    return MAGIC + zlib.compress(pickle.dumps(payload, pickle.HIGHEST_PROTOCOL))
+
+
+def loads(data: bytes) -> ObjectOrientedSystem:
+    if not data.startswith(MAGIC):
+        raise SnapshotError("not a snapshot")
+    payload = pickle.loads(zlib.decompress(data[len(MAGIC) :]))
+
+    system = ObjectOrientedSystem()
+    environment = system.environment
+    class_definitions = environment.class_definitions
+
+    # インスタンスは先に器だけ作り、循環する参照やクラスの初期値からの参照も解決する
+    instances = [Instance.__new__(Instance) for _ in payload["instances"]]
+
+    def value(encoded: tuple[str, Any]) -> Any:
+        kind, data = encoded
+        if kind == "instance":
+            return instances[data]
+        if kind == "primitive":
+            return environment.new_tmp_primitive(data)
+        if kind == "list":
+            return [value(v) for v in data]
+        if kind == "tuple":
+            return tuple(value(v) for v in data)
+        if kind == "dict":
+            return {k: value(v) for k, v in data}
+        return data
+
+    def method(encoded: tuple[str, str, bool]) -> MethodType:
+        kind, path, compiled = encoded
+        func = METHOD_TYPES[kind](import_reference(path))
+        return compile_method(func) if compiled else func
+
+    # 古い定義は登録せずに作り、それを参照する基底クラスやインスタンスに渡す
+    stale: dict[Any, Class] = {}
+
+    def class_of(ref: Any) -> Class:
+        if isinstance(ref, tuple):
+            return stale[ref]
+        return class_definitions.get_class(ref)
+
+    for ref, name, bases, attrs, constructor, methods in payload["classes"]:
+        args = (
+            name,
+            [class_of(base) for base in bases],
+            [ATTR_TYPES[kind](n, value(v)) for kind, n, v in attrs],
+            import_reference(constructor),
+            {n: method(m) for n, m in methods.items()},
+        )
+        if isinstance(ref, tuple):
+            stale[ref] = Class(*args)
+        else:
+            class_definitions.define(*args)
+
+    for instance, (ref, attributes) in zip(instances, payload["instances"]):
+        instance.class_type = class_of(ref)
+        instance.slots = list(instance.class_type.default_slots)
+        for k, v in attributes.items():
+            instance.set_attribute(k, value(v))
+        environment.instance_management.track(instance)
+
+    for name, index in payload["globals"].items():
+        environment.register_instance(name, instances[index])
+    return system
+
+
+def save(system: ObjectOrientedSystem, path: str) -> None:
+    with open(path, "wb") as f:
+        f.write(dumps(system))
+
+
+def load(path: str) -> ObjectOrientedSystem:
+    with open(path, "rb") as f:
+        return loads(f.read())
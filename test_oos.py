@@ -1,8 +1,14 @@
 from typing import Any, Callable
 import pytest
-from exceptions import MethodAccessDenied
+from exceptions import MethodAccessDenied, MethodNotFound, SnapshotError
 from instance import Instance
-from method_accessor import PrivateMethod, PublicMethod
+from instance_management import InstanceManagement
+from method_accessor import (
+    AsyncPrivateMethod,
+    AsyncPublicMethod,
+    PrivateMethod,
+    PublicMethod,
+)
 from oos import ObjectOrientedSystem
 from attr_accessor import PublicAttr, PrivateAttr, ReadonlyAttr
 
@@ -441,3 +447,1063 @@ def test_virtual_bank() -> None:
     assert my_account["dollars"] == 150
     my_account["withdraw"](200)
     assert my_account["dollars"] == 0
+
+
+def test_redefine_base_class() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        bases=["bank"],
+        attrs=[PublicAttr("yen")],
+    )
+    system.send("env", "new", cls="japan_bank", name="my-account")
+    system.send("my-account", "set-dollars", value=100)
+    system.send("my-account", "deposit", value=50)
+    assert system.send("my-account", "get-dollars").value() == 150
+
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        methods={"deposit": PrivateMethod(deposit_by_dollar)},
+    )
+    with pytest.raises(MethodAccessDenied):
+        system.send("my-account", "deposit", value=50)
+
+    # 属性が増えても既存のインスタンスの値は属性名で引き継がれる
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("euro", 0), PublicAttr("dollars")],
+    )
+    assert system.send("my-account", "get-euro").value() == 0
+    assert system.send("my-account", "get-dollars").value() == 150
+    system.send("my-account", "set-yen", value=10)
+    assert system.send("my-account", "get-yen").value() == 10
+
+    child = system.fork()
+    child.send(
+        "env", "define", name="bank", attrs=[PublicAttr("dollars"), PublicAttr("pound")]
+    )
+    assert child.send("my-account", "get-dollars").value() == 150
+    assert child.send("my-account", "get-pound") is None
+    assert system.send("my-account", "get-euro").value() == 0
+
+
+def test_args_do_not_define_classes() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    system.send("env", "new", cls="bank", name="my-account", dollars=100)
+    classes = len(system.environment.class_definitions.classes)
+    for _ in range(10):
+        system.send("my-account", "deposit", value=1)
+    assert system.send("my-account", "get-dollars").value() == 110
+    assert len(system.environment.class_definitions.classes) == classes
+
+
+def test_accessors_are_shared() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+    )
+    a = system.send("env", "new", cls="bank", name="a", dollars=100)
+    b = system.send("env", "new", cls="bank", name="b", dollars=200)
+    assert a.get_method("get-dollars") is b.get_method("get-dollars")
+    assert a.get_method("set-dollars") is b.get_method("set-dollars")
+    assert system.send("a", "get-dollars").value() == 100
+    assert system.send("b", "get-dollars").value() == 200
+
+
+def test_int_subclass_overrides_add() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="inverted_int",
+        bases=["int"],
+        constructor=lambda sys: sys.send(
+            "this", "set-value", value=sys.send("args", "get-value")
+        ),
+        methods={
+            "add": PublicMethod(
+                lambda sys: sys.send("this", "sub", value=sys.send("args", "get-value"))
+            ),
+        },
+    )
+    system.send("env", "new", cls="inverted_int", name="x", value=10)
+    assert system.send("x", "add", value=5).value() == 5
+    assert system.send("x", "multiply", value=3).value() == 30
+    system.send("env", "new", cls="int", name="y", value=10)
+    assert system.send("y", "add", value=-20).value() == -10
+    assert system.send("y", "add", value=system.send("y", "add", value=1)).value() == 21
+
+
+def test_scoped_instances() -> None:
+    system = ObjectOrientedSystem()
+    outer = system.environment.new_tmp_primitive(1)
+    inner = system.environment.new_tmp_primitive(2)
+    instances = InstanceManagement()
+    instances.register_instance("x", outer)
+    instances.push()
+    instances.register_instance("x", inner)
+    instances.register_instance("x", inner)
+    assert instances.get_instance("x") is inner
+    instances.pop()
+    assert instances.get_instance("x") is outer
+    instances.push()
+    instances.register_instance("y", inner)
+    instances.pop()
+    with pytest.raises(Exception):
+        instances.get_instance("y")
+
+
+def test_instance_slot_layout() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars", 1)],
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        attrs=[PublicAttr("yen", 2)],
+    )
+    system.send(
+        "env",
+        "define",
+        name="multi_bank",
+        bases=["bank", "japan_bank"],
+        attrs=[PublicAttr("franc", 3)],
+    )
+    account = system.send("env", "new", cls="multi_bank", name="my-account")
+    assert not hasattr(account, "__dict__")
+    assert account.class_type.layout == {"franc": 0, "dollars": 1, "yen": 2}
+    assert dict(account.attributes) == {
+        "franc": account.slots[0],
+        "dollars": account.slots[1],
+        "yen": account.slots[2],
+    }
+    system.send("my-account", "set-yen", value=20)
+    assert system.send("my-account", "get-yen").value() == 20
+    assert system.send("my-account", "get-dollars").value() == 1
+
+
+def test_new_many() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("yen")],
+        constructor=yen_constructor,
+    )
+    instances = system.send(
+        "env",
+        "new-many",
+        cls="bank",
+        names=["a", "b", "c"],
+        argv=[{"yen": 100}, {"yen": 200}, {"yen": 300}],
+    )
+    assert len(instances) == 3
+    assert system.send("a", "get-yen").value() == 100
+    assert system.send("b", "get-yen").value() == 200
+    assert system.send("c", "get-yen").value() == 300
+    assert system.send("b", "get-yen") is not system.send("c", "get-yen")
+
+    system.send("env", "define", name="empty_bank", attrs=[PublicAttr("yen", 10)])
+    system.send("env", "new-many", cls="empty_bank", names=["d", "e"])
+    assert system.send("e", "get-yen").value() == 10
+
+    with pytest.raises(ValueError):
+        system.send("env", "new-many", cls="bank", names=["f"], argv=[])
+
+
+def test_send_many() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={
+            "deposit": PublicMethod(deposit_by_dollar),
+            "withdraw": PrivateMethod(deposit_by_dollar),
+        },
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        attrs=[PublicAttr("yen")],
+        constructor=yen_constructor,
+        methods={"deposit": PublicMethod(deposit_by_yen)},
+    )
+    system.send("env", "new", cls="bank", name="a", dollars=100)
+    system.send("env", "new", cls="bank", name="b", dollars=200)
+    system.send("env", "new", cls="japan_bank", name="c", yen=300)
+
+    system.send_many(["a", "b", "c"], "deposit", value=10)
+    balances = system.send_many(["a", "b"], "get-dollars")
+    assert [b.value() for b in balances] == [110, 210]
+    assert system.send("c", "get-yen").value() == 310
+
+    system.send_each(["a", "c"], "deposit", [{"value": 1}, {"value": 2}])
+    assert system.send("a", "get-dollars").value() == 111
+    assert system.send("c", "get-yen").value() == 312
+
+    with pytest.raises(MethodAccessDenied):
+        system.send_many(["a"], "withdraw", value=10)
+
+    # env への一括送信も send と同じく呼び出し元のスコープに登録する
+    system.send_many(["env"], "new", cls="int", name="z", value=3)
+    assert system.environment.unbox_primitive(system.send("z", "get-value")) == 3
+    deposit = lambda sys: sys.send_many(["this"], "withdraw", value=5)
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={
+            "withdraw": PrivateMethod(deposit_by_dollar),
+            "pay": PublicMethod(deposit),
+        },
+    )
+    system.send("env", "new", cls="bank", name="d", dollars=100)
+    system.send("d", "pay")
+    assert system.send("d", "get-dollars").value() == 105
+
+
+def test_dispatch_profiler() -> None:
+    from profiler import DispatchProfiler
+
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    system.send("env", "new", cls="bank", name="my-account", dollars=100)
+
+    with DispatchProfiler(system) as profiler:
+        system.send("my-account", "deposit", value=50)
+        system.send("my-account", "deposit", value=50)
+    system.send("my-account", "deposit", value=50)
+    assert "send" not in vars(system)
+
+    stats = {(row["class"], row["method"]): row for row in profiler.report()}
+    assert stats[("bank", "deposit")]["calls"] == 2
+    assert stats[("bank", "set-dollars")]["calls"] == 2
+    assert stats[("int", "add")]["calls"] == 2
+    deposit = stats[("bank", "deposit")]
+    assert deposit["self_time"] <= deposit["total_time"]
+    assert deposit["allocations"] > 0
+    assert profiler.depth_histogram()[1] == 2
+    assert max(profiler.depth_histogram()) > 1
+    assert profiler.export()["counts"]["instances"] >= 2
+    assert "deposit" in profiler.format()
+
+
+def test_benchmark_scenarios() -> None:
+    import benchmark
+
+    results = benchmark.run(list(benchmark.SCENARIOS), iterations=5, repeat=1)
+    assert set(results) == set(benchmark.SCENARIOS)
+    assert all(result["ops_per_sec"] > 0 for result in results.values())
+
+    bank = results["bank"]
+    slower = {"bank": dict(bank, ops_per_sec=bank["ops_per_sec"] / 2)}
+    assert benchmark.compare(slower, results, threshold=0.2)
+    assert not benchmark.compare(results, results, threshold=0.2)
+
+
+def test_compiled_methods() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="base_bank",
+        attrs=[PublicAttr("dollars"), PublicAttr("yen")],
+        methods={"deposit_by_currency": PrivateMethod(deposit_by_dollar)},
+    )
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        bases=["base_bank"],
+        methods={
+            "deposit": PublicMethod(
+                lambda sys: sys.send(
+                    "this", "deposit_by_currency", value=sys.send("args", "get-value")
+                )
+            ),
+        },
+        compile=True,
+    )
+    system.send("env", "new", cls="bank", name="my-account")
+    system.send("my-account", "set-dollars", value=100)
+    system.send("my-account", "set-yen", value=10)
+    system.send("my-account", "deposit", value=50)
+    assert system.send("my-account", "get-dollars").value() == 150
+    with pytest.raises(MethodAccessDenied):
+        system.send("my-account", "deposit_by_currency", value=50)
+
+    # 基底クラスが再定義されると、事前に解決したメソッドは使われなくなる
+    system.send(
+        "env",
+        "define",
+        name="base_bank",
+        attrs=[PublicAttr("dollars"), PublicAttr("yen")],
+        methods={"deposit_by_currency": PrivateMethod(deposit_by_yen)},
+    )
+    system.send("my-account", "deposit", value=5)
+    assert system.send("my-account", "get-dollars").value() == 150
+    assert system.send("my-account", "get-yen").value() == 15
+
+
+def test_send_site() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        attrs=[PublicAttr("yen")],
+        constructor=yen_constructor,
+        methods={"deposit": PrivateMethod(deposit_by_yen)},
+    )
+    system.send("env", "new", cls="bank", name="a", dollars=100)
+    system.send("env", "new", cls="bank", name="b", dollars=100)
+    system.send("env", "new", cls="japan_bank", name="c", yen=100)
+
+    site = system.site("deposit")
+    assert system.site("deposit") is site
+    site.send("a", value=1)
+    site.send("b", value=1)
+    with pytest.raises(MethodAccessDenied):
+        site.send("c", value=1)
+    with pytest.raises(MethodAccessDenied):
+        site.send("c", value=1)
+    assert (site.hits, site.misses) == (2, 2)
+    assert system.send("a", "get-dollars").value() == 101
+    assert system.send("b", "get-dollars").value() == 101
+
+    # 基底クラスが再定義されるとキャッシュは使われない
+    system.send("env", "define", name="base_bank", attrs=[PublicAttr("dollars")])
+    system.send(
+        "env",
+        "define",
+        name="sub_bank",
+        bases=["base_bank"],
+        constructor=dollar_constructor,
+    )
+    system.send("env", "new", cls="sub_bank", name="d", dollars=100)
+    with pytest.raises(MethodNotFound):
+        site.send("d", value=1)
+    system.send(
+        "env",
+        "define",
+        name="base_bank",
+        attrs=[PublicAttr("dollars")],
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    site.send("d", value=1)
+    assert system.send("d", "get-dollars").value() == 101
+    assert site.misses == 4
+
+
+def test_concurrent_sends() -> None:
+    from concurrent.futures import ThreadPoolExecutor
+
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+
+    def work(i: int) -> int:
+        system.send("env", "new", cls="bank", name=f"account-{i}", dollars=i)
+        for _ in range(200):
+            system.send(f"account-{i}", "deposit", value=1)
+        return system.send(f"account-{i}", "get-dollars").value()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(work, range(16)))
+
+    assert results == [i + 200 for i in range(16)]
+    assert system.send("account-3", "get-dollars").value() == 203
+
+
+def test_scopes_released_with_system() -> None:
+    import gc
+    from instance_management import current_scopes
+
+    # 使い捨てのシステムを作っても、スコープはシステムと一緒に消える
+    gc.collect()
+    before = len(current_scopes.get() or {})
+    for _ in range(200):
+        system = ObjectOrientedSystem()
+        system.send("env", "new", cls="int", name="x", value=1)
+    del system
+    gc.collect()
+    assert len(current_scopes.get() or {}) <= before
+
+
+def test_asend() -> None:
+    import asyncio
+
+    async def deposit_later(sys: ObjectOrientedSystem) -> None:
+        balance = sys.send("this", "get-dollars")
+        await asyncio.sleep(0)
+        sys.send(
+            "this",
+            "set-dollars",
+            value=sys.send(balance, "add", value=sys.send("args", "get-value")),
+        )
+
+    async def transfer(sys: ObjectOrientedSystem) -> None:
+        await sys.send("this", "deposit_later", value=sys.send("args", "get-value"))
+        await asyncio.sleep(0)
+        await sys.asend(sys.send("args", "get-to"), "deposit", value=1)
+
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={
+            "deposit_later": AsyncPrivateMethod(deposit_later),
+            "transfer": AsyncPublicMethod(transfer),
+            "deposit": PublicMethod(deposit_by_dollar),
+        },
+    )
+    for i in range(10):
+        system.send("env", "new", cls="bank", name=f"account-{i}", dollars=0)
+
+    async def main() -> None:
+        await asyncio.gather(
+            *(
+                system.asend(f"account-{i}", "transfer", value=i, to="account-0")
+                for i in range(10)
+            )
+        )
+        with pytest.raises(MethodAccessDenied):
+            await system.asend("account-1", "deposit_later", value=1)
+
+    asyncio.run(main())
+    balances = [system.send(f"account-{i}", "get-dollars").value() for i in range(10)]
+    assert balances == [10] + list(range(1, 10))
+
+
+def test_sharded_system() -> None:
+    from method_accessor import MethodReference
+    from sharding import RemoteInstance, ShardedSystem
+
+    with ShardedSystem(2) as system:
+        system.define(
+            name="bank",
+            attrs=[PublicAttr("dollars")],
+            constructor=MethodReference("test_oos:dollar_constructor"),
+            methods={
+                "deposit": PublicMethod(MethodReference("test_oos:deposit_by_dollar"))
+            },
+        )
+        names = [f"account-{i}" for i in range(8)]
+        assert len({system.shard_of(name) for name in names}) == 2
+        system.new_many("bank", names, [{"dollars": i} for i in range(8)])
+        system.send_batch([(name, "deposit", {"value": 100}) for name in names])
+        assert system.send_batch([(name, "get-dollars", {}) for name in names]) == [
+            100 + i for i in range(8)
+        ]
+        account = system.new("bank", "extra", dollars=5)
+        assert isinstance(account, RemoteInstance)
+        assert account.attributes == {"dollars": 5}
+        with pytest.raises(MethodNotFound):
+            system.send("extra", "withdraw", value=1)
+        assert system.send("extra", "get-dollars") == 5
+
+
+def test_snapshot(tmp_path: Any) -> None:
+    import snapshot
+
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars"), PrivateAttr("owner")],
+        constructor=dollar_constructor,
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        bases=["bank"],
+        attrs=[ReadonlyAttr("yen", 10)],
+        methods={"deposit_by_yen": PrivateMethod(deposit_by_yen)},
+        compile=True,
+    )
+    system.send("env", "new", cls="bank", name="a", dollars=100)
+    system.send("env", "new", cls="japan_bank", name="b")
+    system.send("b", "set-dollars", value=200)
+    system.send("a", "deposit", value=5)
+
+    path = str(tmp_path / "system.snapshot")
+    snapshot.save(system, path)
+    restored = snapshot.load(path)
+
+    assert restored.send("a", "get-dollars").value() == 105
+    assert restored.send("b", "get-dollars").value() == 200
+    assert restored.send("b", "get-yen").value() == 10
+    restored.send("b", "deposit", value=1)
+    assert restored.send("b", "get-dollars").value() == 201
+    assert system.send("b", "get-dollars").value() == 200
+    with pytest.raises(MethodAccessDenied):
+        restored.send("b", "deposit_by_yen", value=1)
+    with pytest.raises(MethodAccessDenied):
+        restored.send("b", "set-yen", value=1)
+
+    # 同じ値の属性も、復元後はそれぞれの箱を持つ
+    system.send("env", "new", cls="japan_bank", name="c", yen=100)
+    system.send("b", "set-dollars", value=100)
+    system.send("c", "set-dollars", value=100)
+    restored = snapshot.loads(snapshot.dumps(system))
+    box = restored.send("b", "get-dollars")
+    assert box is not restored.send("c", "get-dollars")
+    restored.send(box, "set-value", value=5)
+    assert restored.send("b", "get-dollars").value() == 5
+    assert restored.send("c", "get-dollars").value() == 100
+
+    # 再定義される前のクラスのインスタンスも、古い定義のまま復元する
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("yen")],
+        constructor=yen_constructor,
+    )
+    system.send("env", "new", cls="bank", name="d", yen=7)
+    restored = snapshot.loads(snapshot.dumps(system))
+    assert restored.send("a", "get-dollars").value() == 105
+    restored.send("a", "deposit", value=1)
+    assert restored.send("a", "get-dollars").value() == 106
+    assert restored.send("d", "get-yen").value() == 7
+    assert restored.send("b", "get-yen").value() == 10
+    with pytest.raises(MethodNotFound):
+        restored.send("d", "get-dollars")
+
+    system.send(
+        "env",
+        "define",
+        name="local",
+        methods={"f": PublicMethod(lambda sys: None)},
+    )
+    with pytest.raises(SnapshotError):
+        snapshot.dumps(system)
+
+
+def test_columnar_storage(tmp_path: Any) -> None:
+    for path in (None, str(tmp_path / "bank")):
+        system = ObjectOrientedSystem()
+        system.send(
+            "env",
+            "define",
+            name="bank",
+            attrs=[
+                PublicAttr("yen"),
+                PublicAttr("dollars", 1.5),
+                PublicAttr("owner"),
+            ],
+            constructor=yen_constructor,
+            methods={"deposit": PublicMethod(deposit_by_yen)},
+        )
+        store = system.send(
+            "env",
+            "columnar",
+            cls="bank",
+            columns={"yen": int, "dollars": "d"},
+            path=path,
+            capacity=2,
+        )
+        names = [f"account-{i}" for i in range(5)]
+        argv = [{"yen": i} for i in range(5)]
+        system.send("env", "new-many", cls="bank", names=names, argv=argv)
+        system.send_many(names, "deposit", value=100)
+        system.send("account-0", "set-owner", value="alice")
+
+        assert system.send("account-4", "get-yen").value() == 104
+        assert system.send("account-4", "get-dollars").value() == 1.5
+        assert system.send("account-0", "get-owner") == "alice"
+        assert sum(store.column("yen")) == 510
+        assert list(store.column("dollars")) == [1.5] * 5
+        with pytest.raises(TypeError):
+            system.send("account-0", "set-yen", value="alice")
+
+        # 列の参照を持ったままでも、インスタンスを増やして領域を広げられる
+        held = store.column("yen")
+        more = [f"account-{i}" for i in range(5, 10)]
+        system.send("env", "new-many", cls="bank", names=more, argv=[{"yen": 1}] * 5)
+        assert store.capacity >= 10
+        assert sum(held) == 510
+        assert sum(store.column("yen")) == 515
+        del held
+        store.close()
+
+
+def test_map_reduce_attr() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("yen")],
+        constructor=yen_constructor,
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        bases=["bank"],
+        attrs=[PublicAttr("dollars")],
+        constructor=yen_constructor,
+    )
+    # 列ストアを作る前のインスタンスも列に移される
+    system.send("env", "new", cls="bank", name="old", yen=1)
+    store = system.send("env", "columnar", cls="bank", columns={"yen": int})
+    system.send(
+        "env",
+        "new-many",
+        cls="bank",
+        names=["a", "b"],
+        argv=[{"yen": 1}, {"yen": 2}],
+    )
+    system.send("env", "new", cls="japan_bank", name="c", yen=3)
+
+    system.send("env", "map-attr", cls="bank", attr="yen", op="add", value=10)
+    assert list(store.column("yen")) == [11, 11, 12]
+    assert system.send("old", "get-yen").value() == 11
+    assert system.send("c", "get-yen").value() == 13
+    total = system.send("env", "reduce-attr", cls="bank", attr="yen", op="add")
+    assert total.value() == 47
+    top = system.send("env", "reduce-attr", cls="bank", attr="yen", op="max")
+    assert top.value() == 13
+
+    # 列に入れた None は 0 にならず、一括計算からも外れる
+    system.send("a", "set-yen", value=None)
+    assert system.send("a", "get-yen") is None
+    total = system.send("env", "reduce-attr", cls="bank", attr="yen", op="add")
+    assert total.value() == 36
+    low = system.send("env", "reduce-attr", cls="bank", attr="yen", op="min")
+    assert low.value() == 11
+    system.send("env", "map-attr", cls="bank", attr="yen", op="add", value=1)
+    assert system.send("a", "get-yen") is None
+    assert system.send("b", "get-yen").value() == 13
+    system.send("a", "set-yen", value=11)
+
+    system.send("env", "map-attr", cls="japan_bank", attr="yen", op="max", value=20)
+    assert system.send("c", "get-yen").value() == 20
+    assert system.send("a", "get-yen").value() == 11
+    empty = system.send(
+        "env", "reduce-attr", cls="japan_bank", attr="dollars", op="add"
+    )
+    assert empty is None
+
+
+def test_delete_and_sweep() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("yen"), PublicAttr("owner")],
+        constructor=yen_constructor,
+        methods={
+            "open": PublicMethod(
+                lambda sys: sys.send("env", "new", cls="bank", name="tmp", yen=0)
+            ),
+        },
+    )
+    store = system.send("env", "columnar", cls="bank", columns={"yen": int})
+    names = [f"account-{i}" for i in range(5)]
+    argv = [{"yen": i} for i in range(5)]
+    system.send("env", "new-many", cls="bank", names=names, argv=argv)
+
+    system.send("env", "delete", name="account-1")
+    system.send("env", "delete", name="account-3")
+    with pytest.raises(Exception):
+        system.send("account-1", "get-yen")
+    assert sorted(store.column("yen")) == [0, 2, 4]
+    assert system.send("account-4", "get-yen").value() == 4
+    system.send("env", "new", cls="bank", name="account-5", yen=5)
+    assert len(store.column("yen")) == 4
+
+    system.send("account-0", "open")
+    with pytest.raises(Exception):
+        system.send("tmp", "get-yen")
+    assert len(store.column("yen")) == 4
+
+    account = system.environment.get_instance("account-2")
+    system.send("account-2", "set-owner", value=account)
+    del account
+    with pytest.raises(MethodNotFound):
+        with system.transaction():
+            system.send("env", "delete", name="account-2")
+            system.send("account-0", "withdraw")
+    assert system.send("env", "query", cls="bank", where={"yen": 2}) != []
+    system.send("env", "delete", name="account-2")
+
+    # 参照が残っていても、消したインスタンスは検索や一括計算から外れる
+    assert system.send("env", "query", cls="bank", where={"yen": 2}) == []
+    total = system.send("env", "reduce-attr", cls="bank", attr="yen", op="add")
+    assert total.value() == 9
+    system.send("env", "map-attr", cls="bank", attr="yen", op="add", value=1)
+    assert sorted(store.column("yen")) == [1, 5, 6]
+    swept = system.send("env", "sweep")
+    assert swept["instances"] == 1
+    assert sorted(store.column("yen")) == [1, 5, 6]
+
+    reclaimed = system.send("env", "reclaimed")
+    assert reclaimed["deleted"] == 3
+    assert reclaimed["released"] == 1
+    assert reclaimed["swept"] == 1
+    assert reclaimed["rows"] == 5
+
+
+def test_primitive_cache() -> None:
+    system = ObjectOrientedSystem()
+    system.send("env", "new", cls="int", name="x", value=1)
+    one = system.send("x", "add", value=0)
+    assert one is system.send("x", "multiply", value=1)
+    assert system.environment.new_tmp_primitive(1.0) is not one
+    assert system.environment.new_tmp_primitive(-0.0) is not (
+        system.environment.new_tmp_primitive(0.0)
+    )
+
+    # 共有された箱は書き換えられず、元の値は変わらない
+    with pytest.raises(TypeError):
+        system.send(one, "set-value", value=2)
+    assert one.value() == 1
+    assert system.send("x", "add", value=0).value() == 1
+
+    # 属性に入れた箱は複製されるので、その場で書き換えられる
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("yen")],
+        constructor=yen_constructor,
+        methods={
+            "reset": PublicMethod(
+                lambda sys: sys.send(sys.send("this", "get-yen"), "set-value", value=7)
+            )
+        },
+    )
+    system.send("env", "new", cls="bank", name="a", yen=1)
+    system.send("env", "new", cls="bank", name="b", yen=1)
+    system.send("a", "reset")
+    assert system.send("a", "get-yen").value() == 7
+    assert system.send("b", "get-yen").value() == 1
+    assert one.value() == 1
+
+    system.send("x", "set-value", value=3)
+    assert system.send("x", "get-value") == 3
+
+    system.environment.primitive_cache.size = 1
+    big = system.environment.new_tmp_primitive(10**6)
+    assert big is system.environment.new_tmp_primitive(10**6)
+    system.environment.new_tmp_primitive(10**7)
+    assert big is not system.environment.new_tmp_primitive(10**6)
+
+
+def test_lazy_builtin_classes() -> None:
+    system = ObjectOrientedSystem()
+    classes = system.environment.class_definitions.classes
+    assert set(classes) == {"environment"}
+
+    system.send("env", "new", cls="float", name="x", value=1.5)
+    assert {"args", "primitive", "float"} <= set(classes)
+    assert "int" not in classes
+    assert system.send("x", "add", value=1.0).value() == 2.5
+    assert system.builtin_classes["float"] is classes["float"]
+    assert classes["float"] in system.environment.primitive_classes
+
+
+def test_fork() -> None:
+    base = ObjectOrientedSystem()
+    base.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars"), PublicAttr("owner")],
+        constructor=dollar_constructor,
+        methods={"deposit": PublicMethod(deposit_by_dollar)},
+    )
+    base.send("env", "define", name="savings", bases=["bank"], attrs=[])
+    store = base.send("env", "columnar", cls="bank", columns={"dollars": int})
+    base.send("env", "new", cls="bank", name="a", dollars=100)
+    base.send("env", "new", cls="savings", name="s")
+    base.send("s", "set-dollars", value=0)
+    base.send("a", "set-owner", value=base.environment.get_instance("s"))
+
+    child = base.fork()
+    assert child.environment.instance_management.globals == {}
+    child.send("a", "deposit", value=10)
+    assert child.send("a", "get-dollars").value() == 110
+    assert base.send("a", "get-dollars").value() == 100
+    assert child.send("a", "get-owner") is child.environment.get_instance("s")
+    assert base.send("a", "get-owner") is base.environment.get_instance("s")
+
+    # 子での再定義は親のクラスにも、親のサブクラスにも影響しない
+    child.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars"), PublicAttr("owner")],
+        methods={"deposit": PrivateMethod(deposit_by_dollar)},
+    )
+    with pytest.raises(MethodAccessDenied):
+        child.send("s", "deposit", value=1)
+    base.send("s", "deposit", value=1)
+    assert base.environment.class_definitions.get_class("savings").bases == [
+        base.environment.class_definitions.get_class("bank")
+    ]
+
+    child.send("env", "new", cls="savings", name="t")
+    child.send("env", "delete", name="a")
+    with pytest.raises(Exception):
+        child.send("a", "get-dollars")
+    with pytest.raises(Exception):
+        base.send("t", "get-dollars")
+    assert base.send("a", "get-dollars").value() == 100
+
+    other = base.fork()
+    other.send("env", "map-attr", cls="bank", attr="dollars", op="add", value=5)
+    assert other.send("a", "get-dollars").value() == 105
+    assert list(store.column("dollars")) == [100]
+    assert base.send("a", "get-dollars").value() == 100
+
+    # 子で親のクラスを継承しても、親のクラスの継承関係には入らない
+    other.send("env", "define", name="sub", bases=["savings"], attrs=[])
+    other.send("env", "new", cls="sub", name="u")
+    other.send("u", "set-dollars", value=7)
+    classes = base.environment.class_definitions
+    assert {c.name for c in classes.get_class("bank").family()} == {"bank", "savings"}
+    assert len(base.send("env", "query", cls="bank")) == 2
+    assert len(other.send("env", "query", cls="bank")) == 3
+    assert other.send("u", "get-dollars").value() == 7
+    base.send("env", "index", cls="bank", attr="dollars")
+    assert base.send("env", "query", cls="bank", where={"dollars": 7}) == []
+
+
+def test_transaction() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("dollars")],
+        constructor=dollar_constructor,
+        methods={
+            "deposit": PublicMethod(deposit_by_dollar),
+            "lock": PrivateMethod(deposit_by_dollar),
+        },
+    )
+    store = system.send("env", "columnar", cls="bank", columns={"dollars": int})
+    system.send("env", "new", cls="bank", name="alice", dollars=100)
+    system.send("env", "new", cls="bank", name="bob", dollars=0)
+
+    def transfer(value: int) -> None:
+        with system.transaction():
+            system.send("alice", "deposit", value=-value)
+            system.send("bob", "deposit", value=value)
+            system.send("env", "new", cls="bank", name="receipt", dollars=value)
+            system.send("bob", "lock", value=value)
+
+    with pytest.raises(MethodAccessDenied):
+        transfer(30)
+    assert system.send("alice", "get-dollars").value() == 100
+    assert system.send("bob", "get-dollars").value() == 0
+    with pytest.raises(Exception):
+        system.send("receipt", "get-dollars")
+
+    # 内側の失敗は内側の変更だけを戻す
+    with system.transaction():
+        system.send("alice", "deposit", value=-10)
+        with pytest.raises(MethodNotFound):
+            with system.transaction():
+                system.send(
+                    "env", "map-attr", cls="bank", attr="dollars", op="add", value=1
+                )
+                system.send("alice", "withdraw", value=1)
+        system.send("bob", "deposit", value=10)
+    assert list(store.column("dollars")) == [90, 10]
+
+
+def test_public_and_internal_tables() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[ReadonlyAttr("dollars", 0)],
+        methods={
+            "deposit": PrivateMethod(deposit_by_dollar),
+            "pay": PublicMethod(
+                lambda sys: sys.send(
+                    "this", "deposit", value=sys.send("args", "get-value")
+                )
+            ),
+        },
+    )
+    system.send("env", "new", cls="bank", name="my-account")
+    _class = system.environment.class_definitions.get_class("bank")
+    assert set(_class.public_table) == {"get-dollars", "pay"}
+    assert {"deposit", "set-dollars"} <= set(_class.method_table)
+
+    system.send("my-account", "pay", value=5)
+    assert system.send("my-account", "get-dollars").value() == 5
+    for method in ("deposit", "set-dollars"):
+        with pytest.raises(MethodAccessDenied):
+            system.send("my-account", method, value=1)
+        with pytest.raises(MethodAccessDenied):
+            system.site(method).send("my-account", value=1)
+    with pytest.raises(MethodNotFound):
+        system.send("my-account", "withdraw", value=1)
+    assert system.site("pay").send("my-account", value=1) is None
+    assert system.send("my-account", "get-dollars").value() == 6
+
+    # env はクラスの情報で呼び出し元のスコープのまま動く
+    env = system.environment.get_instance("env")
+    assert env.class_type.inline
+    system.send(env, "new", cls="bank", name="other")
+    assert system.send("other", "get-dollars").value() == 0
+
+
+def test_query_with_indexes() -> None:
+    system = ObjectOrientedSystem()
+    system.send(
+        "env",
+        "define",
+        name="bank",
+        attrs=[PublicAttr("yen"), PublicAttr("owner")],
+        constructor=yen_constructor,
+    )
+    system.send(
+        "env",
+        "define",
+        name="japan_bank",
+        bases=["bank"],
+        attrs=[PublicAttr("dollars")],
+        constructor=yen_constructor,
+    )
+    system.send(
+        "env",
+        "new-many",
+        cls="bank",
+        names=["a", "b"],
+        argv=[{"yen": 500}, {"yen": 1500}],
+    )
+    system.send("env", "new", cls="japan_bank", name="c", yen=3000)
+    a, b, c = (system.environment.get_instance(name) for name in "abc")
+
+    # 索引が無くても走査で見つかる
+    rich = system.send("env", "query", cls="bank", where={"yen": (">", 1000)})
+    assert set(rich) == {b, c}
+    assert system.send("env", "query", cls="japan_bank") == [c]
+
+    system.send("env", "index", cls="bank", attr="yen", kind="sorted")
+    system.send("env", "index", cls="bank", attr="owner")
+    system.send("b", "set-owner", value="alice")
+    system.send("c", "set-owner", value="alice")
+    query = lambda **where: set(system.send("env", "query", cls="bank", where=where))
+    assert query(yen=(">", 1000)) == {b, c}
+    assert query(yen=("<=", 1500), owner="alice") == {b}
+    assert query(owner=("in", ["alice", "bob"]), yen=lambda v: v % 1000 == 0) == {c}
+
+    system.send("a", "set-yen", value=2000)
+    assert query(yen=(">", 1000)) == {a, b, c}
+    with pytest.raises(MethodNotFound):
+        with system.transaction():
+            system.send("a", "set-yen", value=10)
+            system.send("a", "set-owner", value="alice")
+            assert query(yen=("<", 100)) == {a}
+            system.send("a", "withdraw")
+    assert query(yen=("<", 100)) == set()
+    assert query(owner="alice") == {b, c}
+
+    # None は並べ替えの索引に入らないので、走査で探す
+    system.send("env", "index", cls="japan_bank", attr="dollars", kind="sorted")
+    unset = system.send("env", "query", cls="japan_bank", where={"dollars": None})
+    assert unset == [c]
+
+    # 消したインスタンスは索引からも外れる
+    sorted_index = system.environment.class_definitions.get_class(
+        "japan_bank"
+    ).index_table["yen"][0]
+    system.send("env", "delete", name="c")
+    del c, rich, unset
+    system.send("env", "sweep")
+    assert len(sorted_index.entries) == 2
+
+
+def test_sorted_index_with_incomparable_keys() -> None:
+    system = ObjectOrientedSystem()
+    system.send("env", "define", name="card", attrs=[PublicAttr("code")])
+    for name, code in (("a", 1), ("b", 2), ("c", "x")):
+        system.send("env", "new", cls="card", name=name)
+        system.send(name, "set-code", value=code)
+    c = system.environment.get_instance("c")
+    query = lambda **where: system.send("env", "query", cls="card", where=where)
+    assert query(code="x") == [c]
+
+    # 比較できない値は並べ替えの索引に入らないので、走査で探す
+    system.send("env", "index", cls="card", attr="code", kind="sorted")
+    assert query(code="x") == [c]
+    assert len(query(code=("<", 3))) == 2
+
+    system.send("c", "set-code", value=3)
+    assert query(code=(">", 2)) == [c]
+    assert query(code="x") == []
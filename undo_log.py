@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator, Optional
+
+MISSING = object()
+
+
+class UndoLog:
+    # 書き込み先と元の値だけを積んでおき、失敗したら逆順に戻す
+    # (対象, キー, 元の値) か、戻すための (関数, 引数) を記録する
+    __slots__ = ("entries",)
+
+    def __init__(self) -> None:
+        self.entries: list[tuple[Any, ...]] = []
+
+    def record(self, target: Any, key: Any) -> None:
+        self.entries.append((target, key, target[key]))
+
+    def record_key(self, target: dict[Any, Any], key: Any) -> None:
+        self.entries.append((target, key, target.get(key, MISSING)))
+
+    def call(self, undo: Callable[[Any], Any], argument: Any) -> None:
+        self.entries.append((undo, argument))
+
+    def savepoint(self) -> int:
+        return len(self.entries)
+
+    def rollback(self, savepoint: int = 0) -> None:
+        entries = self.entries
+        while len(entries) > savepoint:
+            entry = entries.pop()
+            if len(entry) == 2:
+                undo, argument = entry
+                undo(argument)
+                continue
+            target, key, value = entry
+            if value is MISSING:
+                target.pop(key, None)
+            else:
+                target[key] = value
+
+
+current_log: ContextVar[Optional[UndoLog]] = ContextVar("undo_log", default=None)
+
+
+@contextmanager
+def transaction() -> Iterator[UndoLog]:
+    # 入れ子のトランザクションはセーブポイントになり、
+    # 内側の失敗は内側で行った変更だけを戻す
+    log = current_log.get()
+    token = None
+    if log is None:
+        log = UndoLog()
+        token = current_log.set(log)
+    savepoint = log.savepoint()
+    try:
+        yield log
+    except BaseException:
+        log.rollback(savepoint)
+        raise
+    finally:
+        if token is not None:
+            current_log.reset(token)
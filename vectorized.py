@@ -0,0 +1,140 @@
+import operator
+from array import array
+from functools import reduce
+from typing import Any, Callable, Optional
+from attr_accessor import AttrSetter, IndexedAttrSetter
+from class_definitions import Class
+from columnar import Column, ColumnStore
+from environment import PRIMITIVE_OPERATIONS, Environment
+from undo_log import current_log
+
+try:
+    import numpy  # type: ignore[import-not-found]
+except ImportError:
+    numpy = None
+
+REDUCTIONS: dict[str, Callable[[Any, Any], Any]] = {
+    "add": operator.add,
+    "multiply": operator.mul,
+    "max": max,
+    "min": min,
+}
+
+
+def numpy_view(column: Column, size: int) -> Any:
+    return numpy.frombuffer(column.buffer, dtype=column.typecode, count=size)
+
+
+def map_column(column: Column, size: int, op: str, value: Any) -> None:
+    log = current_log.get()
+    if log is not None:
+        log.call(column.restore, column.view[:size].tobytes())
+    if numpy is not None:
+        ufunc = {
+            "add": numpy.add,
+            "sub": numpy.subtract,
+            "multiply": numpy.multiply,
+            "max": numpy.maximum,
+        }[op]
+        values = numpy_view(column, size)
+        ufunc(values, value, out=values)
+        return
+    operation = PRIMITIVE_OPERATIONS[op]
+    view = column.view
+    view[:size] = array(column.typecode, [operation(v, value) for v in view[:size]])
+
+
+def reduce_column(column: Column, size: int, op: str) -> Any:
+    # null の行は集計に含めず、全て null なら None を返す
+    if numpy is not None:
+        values = numpy_view(column, size)
+        nulls = numpy.frombuffer(column.nulls, dtype=numpy.bool_, count=size)
+        values = values[~nulls]
+        if not len(values):
+            return None
+        reduction = {
+            "add": numpy.sum,
+            "multiply": numpy.prod,
+            "max": numpy.max,
+            "min": numpy.min,
+        }[op]
+        return reduction(values).item()
+    values = [v for v, null in zip(column.view[:size], column.nulls) if not null]
+    if not values:
+        return None
+    return reduce(REDUCTIONS[op], values)
+
+
+def column_of(
+    environment: Environment, _class: Class, attr: str
+) -> Optional[tuple[Column, int]]:
+    # forkした子からは親の列ストアに書き込まず、複製したインスタンスを使う
+    storage = _class.storage
+    if not environment.class_definitions.owns(_class):
+        return None
+    if isinstance(storage, ColumnStore) and attr in storage.columns:
+        storage.compact()
+        return storage.columns[attr], storage.size
+    return None
+
+
+def reindex(target: tuple[Environment, Class, list[Any]]) -> None:
+    environment, _class, indexes = target
+    for instance in environment.instance_management.instances_of(_class):
+        for index in indexes:
+            index.refresh(instance)
+
+
+def map_attr(
+    environment: Environment, _class: Class, attr: str, op: str, value: Any
+) -> None:
+    # 列に格納されたクラスは列ごとに一括で計算し、それ以外は値を集めて計算して書き戻す
+    operation = PRIMITIVE_OPERATIONS[op]
+    for member in _class.family():
+        if attr not in member.layout:
+            continue
+        indexes = member.index_table.get(attr)
+        column = column_of(environment, member, attr)
+        if column is not None:
+            log = current_log.get()
+            if indexes and log is not None:
+                # 取り消しでは列を戻した後に索引を更新し直す
+                log.call(reindex, (environment, member, indexes))
+            map_column(*column, op, value)
+            if indexes:
+                reindex((environment, member, indexes))
+            continue
+        setter = AttrSetter(attr, member.layout[attr])
+        if indexes:
+            setter = IndexedAttrSetter(attr, member.layout[attr], indexes)
+        for instance in environment.instance_management.instances_of(member):
+            raw = environment.unbox_primitive(instance.slots[setter.index])
+            if raw is not None:
+                boxed = environment.new_tmp_primitive(operation(raw, value))
+                setter.set(instance, boxed)
+
+
+def reduce_attr(
+    environment: Environment, _class: Class, attr: str, op: str
+) -> Optional[Any]:
+    partials = []
+    for member in _class.family():
+        if attr not in member.layout:
+            continue
+        column = column_of(environment, member, attr)
+        if column is not None:
+            partial = reduce_column(*column, op)
+            if partial is not None:
+                partials.append(partial)
+            continue
+        index = member.layout[attr]
+        values = [
+            environment.unbox_primitive(instance.slots[index])
+            for instance in environment.instance_management.instances_of(member)
+        ]
+        values = [v for v in values if v is not None]
+        if values:
+            partials.append(reduce(REDUCTIONS[op], values))
+    if not partials:
+        return None
+    return reduce(REDUCTIONS[op], partials)